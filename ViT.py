@@ -1,43 +1,174 @@
 """# Step 1: Importing the Libraries"""
 
 from torch.optim.lr_scheduler import CosineAnnealingLR
-import torchvision.transforms as transforms
-import torchvision.datasets as datasets
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 import torch.nn.functional as F
+from collections import deque, Counter
+from contextlib import contextmanager, nullcontext
+import torch.distributed as dist
 from typing import List, Dict
+import torch.utils.checkpoint
+import safetensors.torch
 import torch.optim as optim
 from PIL import Image
 import torch.nn as nn
 import numpy as np
+import itertools
+import copy
+import argparse
+import asyncio
+import subprocess
+import tempfile
+import platform
+import hashlib
+import shutil
 import torch
+import json
+import time
+import csv
+import sys
 import os
+import io
 
-"""# Step 2: Select Dataset, Save Directories, and Device"""
+"""# Step 2: Select Dataset, Save Directories, and Device
+The globals below are the defaults. The command line (`python ViT.py train|eval|predict|benchmark|serve`, see the end of the file) overrides them through `configure()`. Importing this file only defines the model, attention and augmentation pieces: datasets, plots and checkpoints are only loaded by the command that needs them.
+"""
 
-mode = 'train' # 'train' or 'load'
+mode = 'train' # Command run when no command is given on the command line: 'train', 'resume', 'eval', 'predict', 'serve', 'benchmark', 'export', 'extract' or 'probe'
 dataset = 'CIFAR10' # 'CIFAR10' or 'MNIST'
-torch_save_dir = r"model.pth" # Choose where to save the model
+torch_save_dir = r"model.safetensors" # Choose where to save the best model weights (.safetensors, or .pth for a PyTorch pickle)
+checkpoint_dir = r"checkpoints" # Full training state (weights, optimizer, GradScaler, scheduler, RNG and metric histories) is saved here for resuming (train --resume)
+keep_last_checkpoints = 3 # Most recent checkpoints kept
+keep_best_checkpoints = 1 # Checkpoints with the lowest validation loss kept in addition
+checkpoint_every_steps = 0 # Also checkpoint every N optimizer steps within an epoch (0 only checkpoints at the end of each epoch)
 CIFAR_testing_dir = r"" # Choose the directory to classify any user inputted image within CIFAR-10 classes. If none, then leave blank.
 MNIST_testing_dir = r"" # Choose the directory to classify any user inputted image within MNIST classes. If none, then leave blank.
+predictions_file = r"predictions.csv" # Predictions for the testing directory are written here incrementally (.csv or .jsonl)
+predict_batch_size = 64 # Images classified per forward pass in predict()
+predict_num_threads = min(8, os.cpu_count() or 1) # Threads decoding images in predict()
+plot_predictions = True # Also save a grid of the first max_plot_images predictions to 'predicted_images.png'
+max_plot_images = 32
+serve_host = '127.0.0.1' # Address of the inference server of the serve command
+serve_port = 8000
+serve_max_batch_size = 32 # Concurrent requests coalesced into one forward pass
+serve_max_wait_ms = 5 # How long the first request of a batch waits for others to join
+device_preference = 'auto' # 'auto' (GPU if available, else CPU), 'cuda' or 'cpu'
+cpu_threads = 0 # Number of intra-op threads on CPU. 0 keeps the PyTorch default (one per physical core).
+cpu_interop_threads = 0 # Number of inter-op threads on CPU. 0 keeps the PyTorch default.
+cpu_bf16 = True # Use bfloat16 autocast on CPU. Disable on CPUs without native bfloat16 support (no AVX512-BF16/AMX).
+channels_last = True # Feed images in channels-last memory format, which is the layout oneDNN prefers for the patch convolution.
+step_trace_file = r"" # Per-step timings of each training phase (data wait, host-to-device copy, augmentation, forward, backward, optimizer step, metrics, checkpoint snapshot, logging) are appended here as JSONL. If none, then leave blank.
+chrome_trace_dir = r"" # Directory for a torch.profiler Chrome trace of a window of training steps in the first epoch. If none, then leave blank.
+chrome_trace_window = (5, 2, 5) # (wait, warmup, active) steps of the profiled window
+activation_checkpointing = False # Recompute each encoder block's activations in the backward pass instead of storing them (less memory, more compute)
+grad_accumulation_steps = 1 # Micro-batches accumulated per optimizer step (effective batch size = 32 * grad_accumulation_steps)
+native_resolution = False # Train at the dataset's native resolution (32px CIFAR-10 / 28px MNIST with 4px patches) instead of upscaling to 224px with 16px patches
+dataset_cache_dir = r"data_cache" # Directory for the uint8 dataset cache at native resolution (about 180 MB for CIFAR-10, 55 MB for MNIST), built once and memory-mapped afterwards; images are resized on the device. If none, then leave blank to decode and resize every sample on the fly.
+num_workers = min(8, os.cpu_count() or 1) # DataLoader worker processes
+prefetch_factor = 4 # Batches prefetched by each DataLoader worker
+augmentation_seed = 0 # Seed for the batched on-device augmentation (None for a different seed every run)
+benchmark_scaling = False # In the benchmark command, also launch 1/2/4-process torchrun runs and report data-parallel scaling efficiency
+benchmark_data = False # In the benchmark command, also measure the data pipeline on the real dataset (downloads it and builds the cache)
+benchmark_results_file = r"benchmark_results.json" # Results of the benchmark suite (`benchmark --suite`) are written here as JSON
+benchmark_baseline_file = r"" # Earlier benchmark suite results to compare against. If none, then leave blank.
+benchmark_regression_threshold = 0.15 # A case whose median time grows by more than this fraction over the baseline is flagged as a regression
+export_dir = r"exports" # Quantized and compiled CPU inference artifacts of the saved model are cached here by the export command
+export_calibration_batches = 8 # Training batches used to calibrate the statically quantized model
+token_reduction = 0 # Tokens merged or pruned after each encoder block (an int for every block, or one value per block). 0 keeps all tokens. Works with existing checkpoints.
+token_reduction_method = 'merge' # 'merge' (ToMe bipartite matching of similar tokens) or 'prune' (drop the patches the class token attends to least)
+exit_layers = () # Add early-exit classifier heads after these numbers of encoder blocks, e.g. (2, 4, 6). Trained jointly with the final head.
+exit_loss_weight = 0.3 # Weight of the (mean) early-exit head loss relative to the final head loss
+exit_threshold = 0.9 # At inference, a sample leaves at the first exit head whose softmax confidence reaches this threshold
+exit_budget_ms = 0 # Latency budget per request in predict/serve: once spent, samples leave at the next exit head. 0 disables the budget.
+finetune_from = r"" # Weights to start training from (e.g. to fine-tune with token reduction enabled). If none, then leave blank.
+feature_store_dir = r"features" # Embeddings written by the extract command (one memory-mapped store per dataset split or image folder)
+feature_chunk_size = 8192 # Embeddings per .npy chunk of a feature store
+feature_dtype = 'float16' # Storage type of the embeddings ('float16' or 'float32'); probes and k-NN compute in float32
+pool_patch_features = False # Also store the mean patch embedding next to the class token embedding
+attention_backend = 'sdpa' # 'sdpa' (fused QKV projection with F.scaled_dot_product_attention) or 'reference' (explicit softmax(QK^T)V)
+
+CLASS_NAMES = {'CIFAR10': ["Airplane", "Automobile", "Bird", "Cat", "Deer", "Dog", "Frog", "Horse", "Ship", "Truck"],
+               'MNIST': ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]}
+
+# When launched with torchrun (e.g. `torchrun --nproc_per_node=4 ViT.py train`), every process trains on its own shard of the data
+distributed = 'RANK' in os.environ and 'WORLD_SIZE' in os.environ
+rank, local_rank, world_size = int(os.environ.get('RANK', 0)), int(os.environ.get('LOCAL_RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+is_main_process = rank == 0
+if not is_main_process:
+    def print(*args, **kwargs): # Only rank 0 prints
+        pass
+
+def configure(**settings):
+    # Override configuration globals (e.g. from the command line) and recompute the values derived from them
+    global device, in_channels, native_image_size, image_size, patch_size
+    unknown = [name for name in settings if name not in globals()]
+    if unknown:
+        raise ValueError(f"Unknown settings: {unknown}")
+    globals().update(settings)
+    if dataset not in CLASS_NAMES:
+        raise ValueError(f"Please select a valid dataset (one of {list(CLASS_NAMES)})!")
+    if device_preference == 'cuda' or (device_preference == 'auto' and torch.cuda.is_available()): # Use GPU if available, else CPU
+        device = torch.device("cuda", local_rank) if distributed else torch.device("cuda")
+    else:
+        device = torch.device("cpu")
+    in_channels = 3 if dataset == 'CIFAR10' else 1
+    native_image_size = 32 if dataset == 'CIFAR10' else 28
+    image_size, patch_size = (native_image_size, 4) if native_resolution else (224, 16)
+
+def init_runtime():
+    # Process-wide setup, run once by the command line before any work: CUDA device, CPU thread counts and the torchrun process group
+    if device.type == 'cuda':
+        if not torch.cuda.is_available():
+            print("Cuda was requested but is not available!")
+            quit()
+        if distributed:
+            torch.cuda.set_device(device)
+        print("Cuda is available. Code will default to GPU.")
+    else:
+        # Thread counts must be set before any parallel work is launched
+        if cpu_threads > 0:
+            torch.set_num_threads(cpu_threads)
+        if cpu_interop_threads > 0:
+            torch.set_num_interop_threads(cpu_interop_threads)
+        print(f"Code will run on CPU with {torch.get_num_threads()} intra-op and {torch.get_num_interop_threads()} inter-op threads (bfloat16 autocast: {cpu_bf16}).")
+    if distributed:
+        # NCCL between GPUs, gloo on CPU-only hosts
+        dist.init_process_group(backend='nccl' if device.type == 'cuda' and dist.is_nccl_available() else 'gloo')
+        print(f"Distributed training with {world_size} processes ({dist.get_backend()} backend).")
+
+configure()
+
+def autocast():
+    # float16 with loss scaling on GPU, bfloat16 (no loss scaling needed) on CPU
+    if device.type == 'cuda':
+        return torch.amp.autocast(device_type='cuda', dtype=torch.float16)
+    return torch.amp.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=cpu_bf16)
 
-if torch.cuda.is_available(): # Use GPU if available, else CPU
-    device = torch.device("cuda")
-    print("Cuda is available. Code will default to GPU.")
-else:
-    device = torch.device("cpu")
-    print("Cuda not available! Code will default to CPU.")
-    quit()
-if dataset != 'CIFAR10' and dataset != 'MNIST':
-    print(f"Please select a valid dataset!")
-if mode == 'load':
-    print(f"Script is currently in '{mode}' mode. Please note this will skip the training process and use the last model checkpoint saved.\n")
-elif mode == 'train':
-    print(f"Script is currently in '{mode}' mode. Please note this will train the model from scratch and overwrite the previous model checkpoint.")
-    print(f"The model will proceed to train on {dataset}.\n")
-else:
-    print(f"Please enter a valid mode (either 'train' or 'load')!")
-    quit()
+def to_device(images):
+    # Move a batch of images to the device, optionally in channels-last layout
+    if channels_last and images.dim() == 4:
+        return images.to(device, memory_format=torch.channels_last, non_blocking=True)
+    return images.to(device, non_blocking=True)
+
+def model_to_device(model):
+    # Move the model to the device, converting the patch convolution weights to channels-last if enabled
+    if channels_last:
+        return model.to(device, memory_format=torch.channels_last)
+    return model.to(device)
+
+def reduce_metrics(*values):
+    # Sum scalars (Python numbers or 0-dim tensors) over all processes; copies them to the host once
+    totals = torch.stack([torch.as_tensor(value, dtype=torch.float64, device=device) for value in values])
+    if distributed:
+        dist.all_reduce(totals)
+    return totals.tolist()
+
+def synchronize():
+    # Wait for queued kernels so that wall-clock timings are accurate
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
 
 """# Step 3: Define a Positional Encoding Class
 This is used to provide positional information to sequences ViTs. This step is crucial for the model to understand the spatial relationships between different parts of the input.
@@ -47,26 +178,49 @@ Parameters are:
 - max_len: The maximum length of input sequences (or number of patches in an image).
 
 
+The table is computed in one vectorized pass and cached per (d_model, max_len, dtype, device), so building several models (or re-plotting the table) never recomputes it. `resize_positional_encoding` interpolates an existing table to another patch grid without recomputing it.
+
 **Note: This code was used in Assignment 4 in ECE 57000.**
 """
 
+_positional_encoding_cache = {}
+
+def get_positional_encoding(d_model, max_len, dtype=torch.float32, device='cpu'):
+    # The returned table is shared by every caller; treat it as read-only (models register their own copy)
+    key = (d_model, max_len, dtype, torch.device(device))
+    if key not in _positional_encoding_cache:
+        # PE[pos, i] = sin(pos / 10000^(i/d_model)) and PE[pos, i + 1] = cos(pos / 10000^(i/d_model)) for even i
+        position = torch.arange(max_len, dtype=torch.float64).unsqueeze(1)
+        angles = position / (10000 ** (torch.arange(0, d_model, 2, dtype=torch.float64) / d_model))
+        positional_encoding = torch.zeros(max_len, d_model, dtype=torch.float64)
+        positional_encoding[:, 0::2] = torch.sin(angles)
+        positional_encoding[:, 1::2] = torch.cos(angles[:, :d_model // 2])
+        _positional_encoding_cache[key] = positional_encoding.to(dtype=dtype, device=device)
+    return _positional_encoding_cache[key]
+
+def resize_positional_encoding(positional_encoding, grid_size):
+    # Interpolate the patch rows of a [1 + old_grid^2, d_model] table to a grid_size x grid_size patch grid, keeping the class token row
+    class_token_encoding, patch_encoding = positional_encoding[:1], positional_encoding[1:]
+    old_grid_size = int(patch_encoding.size(0) ** 0.5)
+    if old_grid_size == grid_size:
+        return positional_encoding
+    patch_encoding = patch_encoding.reshape(1, old_grid_size, old_grid_size, -1).permute(0, 3, 1, 2).float()
+    patch_encoding = F.interpolate(patch_encoding, size=(grid_size, grid_size), mode='bicubic', align_corners=False)
+    patch_encoding = patch_encoding.permute(0, 2, 3, 1).reshape(grid_size * grid_size, -1).to(positional_encoding.dtype)
+    return torch.cat((class_token_encoding, patch_encoding), dim=0)
+
 class PositionalEncoding:
-    def __init__(self, d_model, max_len):
+    def __init__(self, d_model, max_len, dtype=torch.float32, device='cpu'):
         self.d_model = d_model
         self.max_len = max_len
-        self.encoding = self._get_positional_encoding()
+        self.encoding = get_positional_encoding(d_model, max_len, dtype, device)
     def _get_positional_encoding(self):
-        positional_encoding = np.zeros((self.max_len, self.d_model))
-        for pos in range(self.max_len):
-            for i in range(0, self.d_model, 2):
-              positional_encoding[pos, i] = np.sin(pos / (10000 ** (i / self.d_model)))
-              if i + 1 < self.d_model:
-                positional_encoding[pos, i + 1] = np.cos(pos / (10000 ** (i / self.d_model)))
-        return positional_encoding
+        return self.encoding
     def add_positional_encoding(self, input_tensor, positional_encodings):
-        return input_tensor + torch.tensor(positional_encodings).clone().detach().to(input_tensor.device)
+        return input_tensor + torch.as_tensor(positional_encodings).to(device=input_tensor.device, dtype=input_tensor.dtype)
 
 def visualize_positional_encoding(PE):
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(10, 6))
     plt.imshow(PE, aspect='auto', cmap='viridis')
     plt.colorbar(label="Encoding values")
@@ -76,147 +230,407 @@ def visualize_positional_encoding(PE):
     plt.show()
     plt.close()
 d_model = 512
-max_len = (224 // 16) ** 2 + 1
-positional_encoding = PositionalEncoding(d_model, max_len)
-visualize_positional_encoding(positional_encoding._get_positional_encoding())
 
 """# Step 4: Define Multi-Head Self-Attention
 
 This is a a key component of transformer architectures, which allows them to focus on different parts of an input sequence when making predictions. Self-attention allows a model to weigh the importance of different tokens relative to one another. It computes attention scores that dictate how much focus to place on each token while encoding a specific token. For a given input sequence, self-attention calculates three vectors for each token: Query (Q), Key (K), and Value (V). The attention scores are computed using these vectors. Instead of performing a single self-attention operation, multi-head attention runs several self-attention mechanisms in parallel (the "heads"). Each head learns to focus on different aspects of the input sequence.
 
+The Query, Key and Value projections are fused into a single linear layer. Two backends are available:
+- 'sdpa': F.scaled_dot_product_attention, which dispatches to flash / memory-efficient kernels where available and never materializes the full attention matrix.
+- 'reference': the explicit softmax(QK^T / sqrt(d))V computation, kept to check the fused kernels against.
+
+Checkpoints saved with separate query/key/value layers are converted when loaded.
+
+When token reduction follows a block, its attention layer also keeps the mean key of every token (the similarity metric for merging) and the class token's attention to every token (the importance score for pruning). Merged tokens stand for several patches, so the attention adds log(size) to their scores (proportional attention), as if every patch were still there.
+
 **Note: The logic of the code is inspired from the self-attention used in Assignment 4, although there are some differences.**
 """
 
+ATTENTION_BACKENDS = ('sdpa', 'reference')
+
 class MultiHeadSelfAttention(nn.Module):
-    def __init__(self, embedding_dim, num_heads):
+    def __init__(self, embedding_dim, num_heads, backend=None):
         super().__init__()
+        backend = attention_backend if backend is None else backend # Read at construction, so configure() applies
         self.num_heads = num_heads
         self.head_dim = embedding_dim // num_heads
+        self.scale = self.head_dim ** -0.5
         if embedding_dim % num_heads != 0:
-          print("Embedding dimension must be divisible by num_heads")
-          quit()
-        self.query = nn.Linear(embedding_dim, embedding_dim)
-        self.key = nn.Linear(embedding_dim, embedding_dim)
-        self.value = nn.Linear(embedding_dim, embedding_dim)
+            raise ValueError("Embedding dimension must be divisible by num_heads")
+        if backend not in ATTENTION_BACKENDS:
+            raise ValueError(f"Attention backend must be one of {ATTENTION_BACKENDS}")
+        self.backend = backend
+        self.record_token_statistics = False # Set when token reduction follows this layer
+        self.qkv = nn.Linear(embedding_dim, 3 * embedding_dim)
         self.out = nn.Linear(embedding_dim, embedding_dim)
-    def forward(self, input_tensor):
+    def forward(self, input_tensor, token_sizes=None):
         batch_size, seq_len, embedding_dim = input_tensor.size()
-        query = self.query(input_tensor).view(batch_size, seq_len, self.num_heads, self.head_dim).transpose(1, 2)
-        key = self.key(input_tensor).view(batch_size, seq_len, self.num_heads, self.head_dim).transpose(1, 2)
-        value = self.value(input_tensor).view(batch_size, seq_len, self.num_heads, self.head_dim).transpose(1, 2)
-        scores = torch.matmul(query, key.transpose(-2, -1)) / torch.sqrt(torch.tensor(self.head_dim, dtype=torch.float32))
-        attention_weights = F.softmax(scores, dim=-1)
-        attention_output = torch.matmul(attention_weights, value).transpose(1, 2).contiguous().view(batch_size, seq_len, embedding_dim)
+        # One projection for Q, K and V, each split to [batch_size, num_heads, seq_len, head_dim]
+        query, key, value = self.qkv(input_tensor).view(batch_size, seq_len, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4).unbind(0)
+        # Proportional attention: a token merged from n patches counts n times
+        attention_bias = None if token_sizes is None else token_sizes.log().view(batch_size, 1, 1, seq_len).to(query.dtype)
+        if self.backend == 'sdpa':
+            attention_output = F.scaled_dot_product_attention(query, key, value, attn_mask=attention_bias)
+        else:
+            scores = torch.matmul(query, key.transpose(-2, -1)) * self.scale
+            if attention_bias is not None:
+                scores = scores + attention_bias
+            attention_weights = F.softmax(scores, dim=-1)
+            attention_output = torch.matmul(attention_weights, value)
+        if self.record_token_statistics:
+            with torch.no_grad():
+                self.token_keys = key.mean(1) # [batch_size, seq_len, head_dim]
+                class_scores = torch.matmul(query[:, :, :1], key.transpose(-2, -1)) * self.scale
+                if attention_bias is not None:
+                    class_scores = class_scores + attention_bias
+                self.class_attention = F.softmax(class_scores.float(), dim=-1).mean(1).squeeze(1) # [batch_size, seq_len]
+        attention_output = attention_output.transpose(1, 2).reshape(batch_size, seq_len, embedding_dim)
         return self.out(attention_output)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints store separate query/key/value layers; fuse them into the qkv layer
+        for param in ('weight', 'bias'):
+            keys = [f"{prefix}{name}.{param}" for name in ('query', 'key', 'value')]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}qkv.{param}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+def set_attention_backend(model, backend):
+    # Switch every attention layer of an already-built model to another backend
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Attention backend must be one of {ATTENTION_BACKENDS}")
+    for module in model.modules():
+        if isinstance(module, MultiHeadSelfAttention):
+            module.backend = backend
+    return model
 
 """# Step 5: Define a Transformer Encoder Block and Multi-Layer Perceptron (MLP)"""
 
 class TransformerEncoderBlock(nn.Module):
-    def __init__(self, embedding_dim, num_heads, mlp_dim):
+    def __init__(self, embedding_dim, num_heads, mlp_dim, attention_backend=None):
         super().__init__()
-        self.attention = MultiHeadSelfAttention(embedding_dim, num_heads)
+        self.attention = MultiHeadSelfAttention(embedding_dim, num_heads, attention_backend)
         self.norm1 = nn.LayerNorm(embedding_dim)
         self.mlp = nn.Sequential(nn.Linear(embedding_dim, mlp_dim), nn.GELU(), nn.Linear(mlp_dim, embedding_dim))
         self.norm2 = nn.LayerNorm(embedding_dim)
-    def forward(self, input_tensor):
-        x = self.norm1(input_tensor + self.attention(input_tensor))
+    def forward(self, input_tensor, token_sizes=None):
+        x = self.norm1(input_tensor + self.attention(input_tensor, token_sizes))
         return self.norm2(x + self.mlp(x))
 
-"""# Step 6: Define the Vision Transformer"""
+"""# Step 6: Define the Vision Transformer
+Most patches of an upscaled 32x32 image are redundant, so the number of tokens can be reduced between encoder blocks (`set_token_reduction`) with a per-block schedule, without retraining:
+- 'merge' (ToMe): tokens alternate between two sets, every token of the first set is matched with its most similar token of the second (cosine similarity of the attention keys), and the r most similar pairs are averaged, weighted by the number of patches each token already represents.
+- 'prune': the r patch tokens that the class token attends to least are dropped.
+
+The class token is never merged or pruned. Both work in training too, so a checkpoint can be fine-tuned with the reduction enabled.
+
+Optional early-exit heads (`exit_layers`) classify the class token after intermediate blocks. They are trained jointly with the final head, and `forward_early_exit` stops computing a sample as soon as one of them is confident enough (or the sample's latency budget has run out); the remaining samples of the batch continue through the next blocks.
+"""
+
+TOKEN_REDUCTION_METHODS = ('merge', 'prune')
+
+def merge_tokens(embeddings, token_sizes, token_keys, r):
+    batch_size, num_tokens, _ = embeddings.shape
+    r = min(r, (num_tokens + 1) // 2 - 1) # The class token (first of the first set) must stay unmatched
+    if token_sizes is None:
+        token_sizes = torch.ones(batch_size, num_tokens, 1, device=embeddings.device)
+    if r <= 0:
+        return embeddings, token_sizes
+    with torch.no_grad():
+        token_keys = token_keys.float()
+        token_keys = token_keys / token_keys.norm(dim=-1, keepdim=True)
+        scores = torch.matmul(token_keys[:, ::2], token_keys[:, 1::2].transpose(1, 2))
+        scores[:, 0] = float('-inf')
+        best_scores, best_match = scores.max(dim=-1)
+        ranked = best_scores.argsort(dim=-1, descending=True).unsqueeze(-1)
+        unmerged_index = ranked[:, r:].sort(dim=1).values # Sorted, so the class token stays first
+        source_index = ranked[:, :r]
+        destination_index = best_match.unsqueeze(-1).gather(1, source_index)
+    def merge(x):
+        source, destination = x[:, ::2], x[:, 1::2]
+        channels = x.size(-1)
+        unmerged = source.gather(1, unmerged_index.expand(-1, -1, channels))
+        source = source.gather(1, source_index.expand(-1, -1, channels))
+        return torch.cat((unmerged, destination.scatter_reduce(1, destination_index.expand(-1, -1, channels), source, reduce='sum')), dim=1)
+    # Size-weighted average, in float32 so that sums of many tokens stay accurate under autocast
+    merged_sizes = merge(token_sizes)
+    merged = merge(embeddings.float() * token_sizes) / merged_sizes
+    return merged.to(embeddings.dtype), merged_sizes
+
+def prune_tokens(embeddings, token_sizes, class_attention, r):
+    batch_size, num_tokens, embedding_dim = embeddings.shape
+    r = min(r, num_tokens - 2) # Keep the class token and at least one patch
+    if r <= 0:
+        return embeddings, token_sizes
+    kept = class_attention[:, 1:].topk(num_tokens - 1 - r, dim=1).indices.sort(dim=1).values + 1
+    kept = torch.cat((torch.zeros(batch_size, 1, dtype=kept.dtype, device=kept.device), kept), dim=1).unsqueeze(-1)
+    embeddings = embeddings.gather(1, kept.expand(-1, -1, embedding_dim))
+    return embeddings, None if token_sizes is None else token_sizes.gather(1, kept)
+
+def remaining_tokens(num_tokens, schedule, method):
+    # Number of tokens entering each encoder block under a reduction schedule
+    counts = [num_tokens]
+    for r in schedule[:-1]:
+        num_tokens -= max(min(r, (num_tokens + 1) // 2 - 1 if method == 'merge' else num_tokens - 2), 0)
+        counts.append(num_tokens)
+    return counts
 
 class VisionTransformer(nn.Module):
-    def __init__(self, embedding_dim, num_classes, num_heads, num_layers, mlp_dim, image_size=224):
+    def __init__(self, embedding_dim, num_classes, num_heads, num_layers, mlp_dim, image_size=224, patch_size=16, in_channels=3, attention_backend=None, activation_checkpointing=False,
+                 token_reduction=0, token_reduction_method='merge', exit_layers=()):
         super(VisionTransformer, self).__init__()
         # Initialize variables
         self.image_size = image_size
-        self.patch_size = 16
+        self.patch_size = patch_size
         self.num_patches = (image_size // self.patch_size) ** 2
         self.embedding_dim = embedding_dim
-        # First split into 16x16 patches
-        in_channels = 3 if dataset == 'CIFAR10' else 1
+        self.activation_checkpointing = activation_checkpointing
+        # First split into patch_size x patch_size patches
         self.conv_projection = nn.Conv2d(in_channels=in_channels, out_channels=embedding_dim, kernel_size=self.patch_size, stride=self.patch_size)
-        # Then add positional encoding
-        self.positional_encoding = torch.tensor(PositionalEncoding(embedding_dim, self.num_patches + 1).encoding, dtype=torch.float32)
+        # Then add positional encoding (a non-persistent buffer, so it follows model.to() without being saved in checkpoints).
+        # A copy of the cached table, so in-place changes to one model's buffer never reach other models or the cache
+        self.register_buffer('positional_encoding', PositionalEncoding(embedding_dim, self.num_patches + 1).encoding.clone(), persistent=False)
         # Then add the class token
         self.class_token = nn.Parameter(torch.zeros(1, 1, embedding_dim))
         # Now feed into transformer encoder block
-        self.encoder_blocks = nn.ModuleList([TransformerEncoderBlock(embedding_dim, num_heads, mlp_dim) for _ in range(num_layers)])
+        self.encoder_blocks = nn.ModuleList([TransformerEncoderBlock(embedding_dim, num_heads, mlp_dim, attention_backend) for _ in range(num_layers)])
         # Pass through MLP head
         self.mlp_head = nn.Sequential(nn.LayerNorm(embedding_dim), nn.Linear(embedding_dim, num_classes))
+        # Early-exit heads, keyed by the number of encoder blocks before them
+        if any(layer < 1 or layer >= num_layers for layer in exit_layers):
+            raise ValueError(f"Exit layers must be between 1 and {num_layers - 1} (the final head follows block {num_layers})")
+        self.exit_heads = nn.ModuleDict({str(layer): nn.Sequential(nn.LayerNorm(embedding_dim), nn.Linear(embedding_dim, num_classes)) for layer in sorted(set(exit_layers))})
+        self.exit_outputs = [] # Outputs of the exit heads in the last training forward pass
+        self.set_token_reduction(token_reduction, token_reduction_method)
 
-    def forward(self, x):
+    def set_token_reduction(self, schedule, method='merge'):
+        # schedule: tokens removed after each encoder block (the same number after every block, or one value per block; the last block's is unused)
+        if method not in TOKEN_REDUCTION_METHODS:
+            raise ValueError(f"Token reduction method must be one of {TOKEN_REDUCTION_METHODS}")
+        if isinstance(schedule, int) or len(schedule) == 1:
+            schedule = [schedule if isinstance(schedule, int) else schedule[0]] * len(self.encoder_blocks)
+        if len(schedule) != len(self.encoder_blocks):
+            raise ValueError(f"Token reduction schedule needs one value per encoder block ({len(self.encoder_blocks)})")
+        self.token_reduction, self.token_reduction_method = list(schedule), method
+        for i, encoder_block in enumerate(self.encoder_blocks):
+            encoder_block.attention.record_token_statistics = i < len(self.encoder_blocks) - 1 and schedule[i] > 0
+        return self
+
+    def resize_positional_encoding(self, image_size):
+        # Run at another resolution with the same patch size (e.g. evaluate a checkpoint on larger images) by interpolating the positional encoding to the new patch grid
+        self.image_size = image_size
+        self.num_patches = (image_size // self.patch_size) ** 2
+        self.positional_encoding = resize_positional_encoding(self.positional_encoding, image_size // self.patch_size)
+        return self
+
+    def embed(self, x):
         # Project the input image into patch embeddings
         x = self.conv_projection(x).flatten(2).transpose(1, 2) # Flatten and transpose to [batch_size, sequence_length, feature_dimension]
         # Append class token to embeddings
         batch_size = x.size(0)
         expanded_class_token = self.class_token.expand(batch_size, -1, -1)
         embeddings_with_class_token = torch.cat((expanded_class_token, x), dim=1)
-        embeddings = embeddings_with_class_token + self.positional_encoding.unsqueeze(0).to(embeddings_with_class_token.device)
+        return embeddings_with_class_token + self.positional_encoding.unsqueeze(0)
+
+    def run_block(self, index, embeddings, token_sizes):
+        # token_sizes is the number of patches behind every token once tokens have been merged (None before)
+        encoder_block = self.encoder_blocks[index]
+        if self.activation_checkpointing and self.training and torch.is_grad_enabled():
+            # Only the block input is kept; the activations inside the block are recomputed during backward
+            embeddings = torch.utils.checkpoint.checkpoint(encoder_block, embeddings, token_sizes, use_reentrant=False)
+        else:
+            embeddings = encoder_block(embeddings, token_sizes)
+        if encoder_block.attention.record_token_statistics: # Reduce the tokens before the next block
+            if self.token_reduction_method == 'merge':
+                return merge_tokens(embeddings, token_sizes, encoder_block.attention.token_keys, self.token_reduction[index])
+            return prune_tokens(embeddings, token_sizes, encoder_block.attention.class_attention, self.token_reduction[index])
+        return embeddings, token_sizes
+
+    def forward_with_exits(self, x, exits=True):
+        embeddings, token_sizes = self.embed(x), None
         # Pass the embeddings through Transformer encoder blocks
-        for encoder_block in self.encoder_blocks:
-            embeddings = encoder_block(embeddings)
+        exit_outputs = []
+        for index in range(len(self.encoder_blocks)):
+            embeddings, token_sizes = self.run_block(index, embeddings, token_sizes)
+            if exits and str(index + 1) in self.exit_heads:
+                exit_outputs.append(self.exit_heads[str(index + 1)](embeddings[:, 0]))
         # Output the class token embedding after the last encoder block
-        return self.mlp_head(embeddings[:, 0])
+        return self.mlp_head(embeddings[:, 0]), exit_outputs
+
+    def forward(self, x):
+        # A single tensor argument, so the model stays traceable (FX quantization, TorchScript, ONNX)
+        if self.training and len(self.exit_heads) > 0:
+            # The exit heads train jointly with the final head; train() reads their outputs from here, since DDP only synchronizes gradients through forward
+            output, self.exit_outputs = self.forward_with_exits(x)
+            return output
+        return self.forward_with_exits(x, exits=False)[0]
+
+    def extract_features(self, x, pool_patches=False):
+        # The class token embedding after the last block, normalized by the head's LayerNorm (the input of its Linear layer), and optionally the normalized mean patch embedding
+        embeddings, token_sizes = self.embed(x), None
+        for index in range(len(self.encoder_blocks)):
+            embeddings, token_sizes = self.run_block(index, embeddings, token_sizes)
+        class_features = self.mlp_head[0](embeddings[:, 0])
+        if not pool_patches:
+            return class_features, None
+        patches = embeddings[:, 1:]
+        pooled = patches.mean(1) if token_sizes is None else (patches * token_sizes[:, 1:]).sum(1) / token_sizes[:, 1:].sum(1) # Merged tokens weigh by their size
+        return class_features, self.mlp_head[0](pooled.to(patches.dtype))
+
+    @torch.no_grad()
+    def forward_early_exit(self, x, threshold=0.9, budget_ms=None):
+        # Returns the logits and the number of encoder blocks run for every sample. budget_ms is one latency budget for the batch, or one per sample.
+        start = time.perf_counter()
+        batch_size, num_blocks = x.size(0), len(self.encoder_blocks)
+        embeddings, token_sizes = self.embed(x), None
+        output = torch.empty(batch_size, self.mlp_head[-1].out_features, device=x.device)
+        layers = torch.full((batch_size,), num_blocks, dtype=torch.long, device=x.device)
+        active = torch.arange(batch_size, device=x.device) # Samples still being computed
+        budgets = None if budget_ms is None else torch.as_tensor(budget_ms, dtype=torch.float32).expand(batch_size).to(x.device)
+        for index in range(num_blocks - 1):
+            embeddings, token_sizes = self.run_block(index, embeddings, token_sizes)
+            if str(index + 1) not in self.exit_heads:
+                continue
+            exit_output = self.exit_heads[str(index + 1)](embeddings[:, 0]).float()
+            done = F.softmax(exit_output, dim=1).max(1).values >= threshold
+            if budgets is not None:
+                if x.device.type == 'cuda':
+                    torch.cuda.synchronize(x.device)
+                done |= budgets[active] <= 1000 * (time.perf_counter() - start)
+            if done.any():
+                output[active[done]] = exit_output[done]
+                layers[active[done]] = index + 1
+                keep = ~done
+                active, embeddings = active[keep], embeddings[keep]
+                token_sizes = None if token_sizes is None else token_sizes[keep]
+                if active.numel() == 0:
+                    return output, layers
+        embeddings, token_sizes = self.run_block(num_blocks - 1, embeddings, token_sizes)
+        output[active] = self.mlp_head(embeddings[:, 0]).float()
+        return output, layers
 
-"""# Step 7: Define Data Augmentation (MixUp and CutMix) Functions"""
+"""# Step 7: Define Data Augmentation (MixUp and CutMix) Functions
 
-def mixup_data(images, targets, alpha=0.4):
-    # lambda is from the beta distribution Beta(α, α)
-    lam = np.random.beta(alpha, alpha) if alpha > 0 else 1
+MixUp and CutMix draw one lambda per sample (and one CutMix box per sample), so a batch mixes with different strengths. `BatchAugmentation` runs the whole training augmentation stack on a uint8 batch that is already on the device: RandomResizedCrop, horizontal flip and rotation are folded into one affine warp per image (a single `grid_sample`), followed by normalization and MixUp/CutMix. All random parameters come from a seeded NumPy generator, so runs are reproducible.
+"""
+
+def mixup_data(images, targets, alpha=0.4, rng=None):
+    rng = np.random if rng is None else rng
+    # lambda is from the beta distribution Beta(α, α), one per sample
+    lam = rng.beta(alpha, alpha, size=images.size(0)) if alpha > 0 else np.ones(images.size(0))
+    lam = torch.as_tensor(lam, dtype=torch.float32).to(images.device, non_blocking=True)
     # This will be used to select a different image for mixing.
-    index = torch.randperm(images.size(0)).to(images.device)
+    index = torch.as_tensor(rng.permutation(images.size(0))).to(images.device, non_blocking=True)
     # The mixing formula is: mixed_images = lam * images + (1 - lam) * images[index]
-    mixed_images = lam * images + (1 - lam) * images[index, :]
+    mixed_images = torch.lerp(images[index], images, lam.view(-1, 1, 1, 1).to(images.dtype))
     return mixed_images, targets, targets[index], lam
 
-def cutmix_data(images, targets, alpha=1.0):\
-    # lambda is from the beta distribution Beta(α, α)
-    lam = np.random.beta(alpha, alpha) if alpha > 0 else 1
+def cutmix_data(images, targets, alpha=1.0, rng=None):
+    rng = np.random if rng is None else rng
+    batch_size, _, H, W = images.size()
+    # lambda is from the beta distribution Beta(α, α), one per sample
+    lam = rng.beta(alpha, alpha, size=batch_size) if alpha > 0 else np.ones(batch_size)
     # This will be used to select a different image for mixing.
-    index = torch.randperm(images.size(0), device=images.device)
-    # Get image size
-    _, _, H, W = images.size()
+    index = torch.as_tensor(rng.permutation(batch_size)).to(images.device, non_blocking=True)
     # r_w, r_h = W*sqrt(1-lam), H*sqrt(1-lam)
-    cut_w, cut_h = int(W * np.sqrt(1. - lam)), int(H * np.sqrt(1. - lam))
-    # Center coordinates of the cut region
-    cx, cy = torch.randint(0, W, (1,), device=images.device).item(), torch.randint(0, H, (1,), device=images.device).item()
+    cut_w, cut_h = (W * np.sqrt(1. - lam)).astype(np.int64), (H * np.sqrt(1. - lam)).astype(np.int64)
+    # Center coordinates of the cut regions
+    cx, cy = (rng.random(batch_size) * W).astype(np.int64), (rng.random(batch_size) * H).astype(np.int64)
     # Re-calculate to capture boundaries
-    x1, x2 = max(cx - cut_w // 2, 0), min(cx + cut_w // 2, W)
-    y1, y2 = max(cy - cut_h // 2, 0), min(cy + cut_h // 2, H)
-    # Combine images
-    images[:, :, y1:y2, x1:x2] = images[index, :, y1:y2, x1:x2]
+    x1, x2 = np.clip(cx - cut_w // 2, 0, W), np.clip(cx + cut_w // 2, 0, W)
+    y1, y2 = np.clip(cy - cut_h // 2, 0, H), np.clip(cy + cut_h // 2, 0, H)
+    # Combine images with one box mask per sample
+    boxes = torch.as_tensor(np.stack([x1, x2, y1, y2])).to(images.device, non_blocking=True).view(4, batch_size, 1)
+    columns, rows = torch.arange(W, device=images.device), torch.arange(H, device=images.device)
+    mask = ((rows >= boxes[2]) & (rows < boxes[3])).unsqueeze(2) & ((columns >= boxes[0]) & (columns < boxes[1])).unsqueeze(1)
+    images = torch.where(mask.unsqueeze(1), images[index], images)
     # lambda' = 1 - (r_w*r_h / W*H)
-    lam = 1 - ((x2 - x1) * (y2 - y1) / (W * H))
+    lam = torch.as_tensor(1 - ((x2 - x1) * (y2 - y1) / (W * H)), dtype=torch.float32).to(images.device, non_blocking=True)
     return images, targets, targets[index], lam
 
+class BatchAugmentation:
+    def __init__(self, image_size, mean, std, train=True, geometric=True, scale=(0.8, 1.0), ratio=(3 / 4, 4 / 3), degrees=10, alpha=0.4, seed=None):
+        self.image_size = image_size
+        self.mean, self.std = mean, std
+        self.train = train
+        self.geometric = geometric
+        self.scale, self.ratio, self.degrees = scale, ratio, degrees
+        self.alpha = alpha
+        self.rng = np.random.default_rng(seed)
+        self._normalization = {}
+    def normalize(self, images):
+        # (images / 255 - mean) / std as a single multiply-add, with the constants kept on the images' device
+        if images.device not in self._normalization:
+            std = torch.tensor(self.std, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+            mean = torch.tensor(self.mean, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+            self._normalization[images.device] = (-mean / std, 1 / (255 * std))
+        shift, scale = self._normalization[images.device]
+        return torch.addcmul(shift, images.float(), scale)
+    def random_affine(self, batch_size):
+        # RandomResizedCrop, RandomHorizontalFlip and RandomRotation as one [batch_size, 2, 3] matrix per image in normalized coordinates
+        area = self.rng.uniform(*self.scale, size=batch_size)
+        aspect_ratio = np.exp(self.rng.uniform(np.log(self.ratio[0]), np.log(self.ratio[1]), size=batch_size))
+        width, height = np.minimum(np.sqrt(area * aspect_ratio), 1.0), np.minimum(np.sqrt(area / aspect_ratio), 1.0)
+        center_x, center_y = self.rng.uniform(-1, 1, size=batch_size) * (1 - width), self.rng.uniform(-1, 1, size=batch_size) * (1 - height)
+        flip = np.where(self.rng.random(batch_size) < 0.5, -1.0, 1.0)
+        angle = np.deg2rad(self.rng.uniform(-self.degrees, self.degrees, size=batch_size))
+        theta = np.zeros((batch_size, 2, 3), dtype=np.float32)
+        # Crop scale (with the flip) times rotation, translated to the crop center
+        theta[:, 0, 0], theta[:, 0, 1], theta[:, 0, 2] = width * flip * np.cos(angle), -width * flip * np.sin(angle), center_x
+        theta[:, 1, 0], theta[:, 1, 1], theta[:, 1, 2] = height * np.sin(angle), height * np.cos(angle), center_y
+        return torch.from_numpy(theta)
+    def resize(self, images):
+        # The dataset cache stores native-resolution images; they are upscaled to the model's image size here, on the device
+        if images.shape[-2:] == (self.image_size, self.image_size):
+            return images
+        return F.interpolate(images.float(), size=(self.image_size, self.image_size), mode='bilinear', align_corners=False)
+    def __call__(self, images, targets=None):
+        # images is a uint8 [batch_size, channels, height, width] batch on the device, at any resolution
+        if not self.train:
+            return self.normalize(self.resize(images))
+        images = images.float()
+        if self.geometric: # The warp samples the output at image_size directly
+            theta = self.random_affine(images.size(0)).to(images.device, non_blocking=True)
+            grid = F.affine_grid(theta, [images.size(0), images.size(1), self.image_size, self.image_size], align_corners=False)
+            images = F.grid_sample(images, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        else:
+            images = self.resize(images)
+        images = self.normalize(images)
+        if targets is None:
+            return images
+        # Randomly pick between CutMix or MixUp
+        if self.rng.random() < 0.5:
+            return cutmix_data(images, targets, alpha=self.alpha, rng=self.rng)
+        return mixup_data(images, targets, alpha=self.alpha, rng=self.rng)
 
-# Visualize MixUp and CutMix using solid colors
-batch_size, channels, height, width = 4, 3, 32, 32
-colors = torch.tensor([
-    [1.0, 0.0, 0.0],  # Red
-    [0.0, 1.0, 0.0],  # Green
-    [0.0, 0.0, 1.0],  # Blue
-    [1.0, 1.0, 0.0],  # Yellow
-]).view(batch_size, channels, 1, 1)
-images = colors.expand(batch_size, channels, height, width)
-targets = torch.arange(batch_size)
-mixup_images, mixup_targets_a, mixup_targets_b, mixup_lam = mixup_data(images.clone(), targets, alpha=0.4)
-cutmix_images, cutmix_targets_a, cutmix_targets_b, cutmix_lam = cutmix_data(images.clone(), targets, alpha=1.0)
-fig, axs = plt.subplots(3, batch_size, figsize=(12, 9))
-for i in range(batch_size):
-    axs[0, i].imshow(images[i].permute(1, 2, 0).cpu().numpy())
-    axs[0, i].set_title(f"Original: {targets[i].item()}")
-    axs[0, i].axis('off')
-    axs[1, i].imshow(mixup_images[i].permute(1, 2, 0).cpu().numpy())
-    axs[1, i].set_title(f"Mixup: {mixup_targets_a[i].item()} & {mixup_targets_b[i].item()} (λ={mixup_lam:.2f})")
-    axs[1, i].axis('off')
-    axs[2, i].imshow(cutmix_images[i].permute(1, 2, 0).cpu().numpy())
-    axs[2, i].set_title(f"CutMix: {cutmix_targets_a[i].item()} & {cutmix_targets_b[i].item()} (λ={cutmix_lam:.2f})")
-    axs[2, i].axis('off')
-plt.tight_layout()
-plt.savefig("augmentation_sample.png")
-plt.show()
-plt.close()
+def visualize_augmentation():
+    # Visualize MixUp and CutMix using solid colors
+    import matplotlib.pyplot as plt
+    batch_size, channels, height, width = 4, 3, 32, 32
+    colors = torch.tensor([
+        [1.0, 0.0, 0.0],  # Red
+        [0.0, 1.0, 0.0],  # Green
+        [0.0, 0.0, 1.0],  # Blue
+        [1.0, 1.0, 0.0],  # Yellow
+    ]).view(batch_size, channels, 1, 1)
+    images = colors.expand(batch_size, channels, height, width)
+    targets = torch.arange(batch_size)
+    mixup_images, mixup_targets_a, mixup_targets_b, mixup_lam = mixup_data(images.clone(), targets, alpha=0.4)
+    cutmix_images, cutmix_targets_a, cutmix_targets_b, cutmix_lam = cutmix_data(images.clone(), targets, alpha=1.0)
+    fig, axs = plt.subplots(3, batch_size, figsize=(12, 9))
+    for i in range(batch_size):
+        axs[0, i].imshow(images[i].permute(1, 2, 0).cpu().numpy())
+        axs[0, i].set_title(f"Original: {targets[i].item()}")
+        axs[0, i].axis('off')
+        axs[1, i].imshow(mixup_images[i].permute(1, 2, 0).cpu().numpy())
+        axs[1, i].set_title(f"Mixup: {mixup_targets_a[i].item()} & {mixup_targets_b[i].item()} (λ={mixup_lam[i]:.2f})")
+        axs[1, i].axis('off')
+        axs[2, i].imshow(cutmix_images[i].permute(1, 2, 0).cpu().numpy())
+        axs[2, i].set_title(f"CutMix: {cutmix_targets_a[i].item()} & {cutmix_targets_b[i].item()} (λ={cutmix_lam[i]:.2f})")
+        axs[2, i].axis('off')
+    plt.tight_layout()
+    plt.savefig("augmentation_sample.png")
+    plt.show()
+    plt.close()
 
 """# Step 8: Define Train and Test Functions
 
@@ -225,120 +639,1091 @@ plt.close()
 - Apply Cutmix and Mixup augmentation during training
 
 - Record train/test accuracies and train/test losses
+
+- With early-exit heads, add their mean loss (weighted by `exit_loss_weight`) to the final head's loss
+
+- Optionally accumulate gradients over several micro-batches per optimizer step. Each micro-batch loss (with its own MixUp/CutMix lambdas) is divided by the number of micro-batches in its group, the GradScaler is only stepped and updated once per group, and the CosineAnnealingLR keeps stepping once per epoch.
+
+- With torchrun, every process trains a DistributedDataParallel replica on its own shard. The train and test metrics are summed over all processes, so the recorded curves describe the whole dataset.
+
+- Accumulate the metrics on the device and only copy them to the host at log intervals, since every `.item()` waits for the device
+
+- Checkpoint the full training state with `CheckpointManager`. The state is copied to host memory on the training thread, then written on a background thread into a temporary directory that is atomically renamed into place, so training doesn't wait for the disk and a crash never leaves a half-written checkpoint. The last `keep_last_checkpoints` and best `keep_best_checkpoints` are kept. Weights are stored as safetensors, which are memory-mapped when loaded.
+
+- Time every training phase per step with `StepProfiler`. On GPU the phases are timed with CUDA events that are only read at log intervals, so the timing itself adds no syncs.
 """
 
+def load_weights(model, path, new_exit_heads=False):
+    # safetensors are memory-mapped instead of unpickled; .pth checkpoints (including ones with separate query/key/value layers) are memory-mapped too
+    if path.endswith('.safetensors'):
+        state_dict = safetensors.torch.load_file(path, device=str(device))
+    else:
+        state_dict = torch.load(path, map_location=device, weights_only=True, mmap=True)
+    # Early-exit heads may be missing from the checkpoint (or from the model); everything else must match
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    missing_exit_heads = [key for key in missing if key.startswith('exit_heads.')]
+    missing = [key for key in missing if not key.startswith('exit_heads.')]
+    unexpected = [key for key in unexpected if not key.startswith('exit_heads.')]
+    if missing or unexpected:
+        raise RuntimeError(f"Checkpoint '{path}' does not match the model (missing keys: {missing}, unexpected keys: {unexpected})")
+    if missing_exit_heads:
+        layers = sorted({key.split('.')[1] for key in missing_exit_heads}, key=int)
+        if new_exit_heads: # Fine-tuning: the new heads start from a random initialization and are trained
+            print(f"Checkpoint '{path}' has no weights for the early-exit heads after blocks {layers}; they will be trained from scratch.")
+        else:
+            # Untrained heads would make samples exit on random predictions, so inference runs without them
+            for layer in layers:
+                del model.exit_heads[layer]
+            print(f"Checkpoint '{path}' has no weights for the early-exit heads after blocks {layers}; running without them. Train them with --finetune-from to use early exits.")
+    return model
+
+def save_weights(weights, path):
+    # Write to a temporary file and rename it into place, so readers never see a partial file
+    if path.endswith('.safetensors'):
+        safetensors.torch.save_file(weights, path + '.tmp')
+    else:
+        torch.save(weights, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def copy_to_host(obj):
+    # Detached host copy of every tensor in a (nested) state dict, so training can keep updating the originals
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: copy_to_host(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_host(value) for value in obj)
+    return obj
+
+class CheckpointManager:
+    def __init__(self, directory, model, optimizer, scaler, scheduler, augmentation=None, histories=None, keep_last=None, keep_best=None, best_weights_path=None):
+        self.directory = directory
+        self.model, self.optimizer, self.scaler, self.scheduler, self.augmentation = model, optimizer, scaler, scheduler, augmentation
+        self.histories = histories or {} # Metric lists, saved and restored in place
+        self.keep_last = keep_last_checkpoints if keep_last is None else keep_last
+        self.keep_best = keep_best_checkpoints if keep_best is None else keep_best
+        self.best_weights_path = torch_save_dir if best_weights_path is None else best_weights_path
+        self.best_val_loss = float('inf')
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        if is_main_process:
+            os.makedirs(directory, exist_ok=True)
+
+    def clear(self):
+        # Start a fresh run: remove the checkpoints of previous runs
+        if is_main_process:
+            for checkpoint in self.list_checkpoints():
+                shutil.rmtree(checkpoint['path'], ignore_errors=True)
+
+    def save(self, epoch, batch=0, val_loss=None, epoch_totals=None, export_best=False):
+        # Resuming from this checkpoint continues at batch `batch` of epoch `epoch`
+        if not is_main_process:
+            return
+        weights = {key: value.contiguous() for key, value in copy_to_host(self.model.state_dict()).items()}
+        training_state = copy_to_host({
+            'epoch': epoch, 'batch': batch, 'best_val_loss': self.best_val_loss, 'epoch_totals': epoch_totals,
+            'optimizer': self.optimizer.state_dict(), 'scaler': self.scaler.state_dict(), 'scheduler': self.scheduler.state_dict(),
+            'histories': {name: list(values) for name, values in self.histories.items()},
+            'rng': {'torch': torch.get_rng_state(), 'cuda': torch.cuda.get_rng_state_all() if device.type == 'cuda' else None, 'numpy': np.random.get_state(),
+                    'augmentation': self.augmentation.rng.bit_generator.state if self.augmentation is not None else None}})
+        meta = {'epoch': epoch, 'batch': batch, 'val_loss': val_loss, 'time': time.time()}
+        self.wait() # At most one write in flight, which bounds the host memory used by snapshots
+        self.pending = self.writer.submit(self._write, f"epoch{epoch:04d}_batch{batch:06d}", weights, training_state, meta, export_best)
+
+    def _write(self, name, weights, training_state, meta, export_best):
+        path = os.path.join(self.directory, name)
+        temporary_path = path + '.tmp'
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+        safetensors.torch.save_file(weights, os.path.join(temporary_path, 'model.safetensors'))
+        torch.save(training_state, os.path.join(temporary_path, 'training_state.pt'))
+        with open(os.path.join(temporary_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temporary_path, path)
+        if export_best:
+            save_weights(weights, self.best_weights_path)
+        self._evict()
+
+    def _evict(self):
+        checkpoints = sorted(self.list_checkpoints(), key=lambda checkpoint: (checkpoint['epoch'], checkpoint['batch']))
+        keep = {checkpoint['path'] for checkpoint in checkpoints[-self.keep_last:]} if self.keep_last > 0 else set()
+        validated = sorted((checkpoint for checkpoint in checkpoints if checkpoint['val_loss'] is not None), key=lambda checkpoint: checkpoint['val_loss'])
+        keep |= {checkpoint['path'] for checkpoint in validated[:self.keep_best]}
+        for checkpoint in checkpoints:
+            if checkpoint['path'] not in keep:
+                shutil.rmtree(checkpoint['path'], ignore_errors=True)
+
+    def list_checkpoints(self):
+        checkpoints = []
+        if not os.path.isdir(self.directory):
+            return checkpoints
+        for name in os.listdir(self.directory):
+            meta_path = os.path.join(self.directory, name, 'meta.json')
+            if not name.endswith('.tmp') and os.path.exists(meta_path):
+                with open(meta_path) as f:
+                    checkpoints.append(dict(json.load(f), path=os.path.join(self.directory, name)))
+        return checkpoints
+
+    def load_latest(self):
+        # Restore the most recent checkpoint in place and return its training state (None if there is none)
+        checkpoints = self.list_checkpoints()
+        if not checkpoints:
+            return None
+        path = max(checkpoints, key=lambda checkpoint: (checkpoint['epoch'], checkpoint['batch']))['path']
+        load_weights(self.model, os.path.join(path, 'model.safetensors'))
+        state = torch.load(os.path.join(path, 'training_state.pt'), map_location='cpu', weights_only=False) # Written by this script; includes NumPy RNG state
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scaler.load_state_dict(state['scaler'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        for name, values in state['histories'].items():
+            if name in self.histories:
+                self.histories[name][:] = values
+        self.best_val_loss = state['best_val_loss']
+        torch.set_rng_state(state['rng']['torch'])
+        if state['rng']['cuda'] is not None and device.type == 'cuda':
+            torch.cuda.set_rng_state_all(state['rng']['cuda'])
+        np.random.set_state(state['rng']['numpy'])
+        if self.augmentation is not None and state['rng']['augmentation'] is not None and is_main_process: # Other processes keep their own seeds
+            self.augmentation.rng.bit_generator.state = state['rng']['augmentation']
+        print(f"Resumed from '{path}' (epoch {state['epoch']}, batch {state['batch']})")
+        return state
+
+    def wait(self):
+        # Block until the pending write has finished (and surface its errors)
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+class StepProfiler:
+    PHASES = ('data_wait', 'h2d', 'augmentation', 'forward', 'backward', 'optimizer', 'metrics', 'checkpoint', 'log')
+    def __init__(self, trace_file=None, epoch=0, chrome_trace_dir=None, chrome_trace_window=None):
+        # Settings default to the globals at construction time, so configure() applies
+        trace_file = step_trace_file if trace_file is None else trace_file
+        chrome_trace_dir = globals()['chrome_trace_dir'] if chrome_trace_dir is None else chrome_trace_dir
+        chrome_trace_window = globals()['chrome_trace_window'] if chrome_trace_window is None else chrome_trace_window
+        if distributed and trace_file != "": # One trace per process
+            root, extension = os.path.splitext(trace_file)
+            trace_file = f"{root}.rank{rank}{extension}"
+        self.trace_file = trace_file
+        self.enabled = trace_file != ""
+        self.epoch = epoch
+        self.use_events = device.type == 'cuda'
+        self.step = 0
+        self.pending = [] # Steps whose CUDA events have not been read yet
+        self.totals = dict.fromkeys(self.PHASES + ('step',), 0.0)
+        self.num_steps = 0
+        self.last_step_end = time.perf_counter()
+        self.profiler = None
+        if chrome_trace_dir != "":
+            os.makedirs(chrome_trace_dir, exist_ok=True)
+            wait, warmup, active = chrome_trace_window
+            trace_path = os.path.join(chrome_trace_dir, f"trace_epoch{epoch}" + (f"_rank{rank}" if distributed else "") + ".json")
+            self.profiler = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if device.type == 'cuda' else []),
+                schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+                on_trace_ready=lambda profiler: profiler.export_chrome_trace(trace_path))
+            self.profiler.start()
+    def begin_step(self):
+        self.step_start = time.perf_counter()
+        self.record = {'epoch': self.epoch, 'step': self.step, 'data_wait_ms': 1000 * (self.step_start - self.last_step_end)}
+        self.events = []
+    @contextmanager
+    def phase(self, name, host=False):
+        # Also labels the phase in the Chrome trace. Host phases (checkpointing, logging) stall the host rather than queue kernels, so they are always timed on the host.
+        with torch.profiler.record_function(name):
+            if not self.enabled:
+                yield
+            elif self.use_events and not host:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self.events.append((name, start, end))
+            else:
+                start = time.perf_counter()
+                yield
+                self.record[f"{name}_ms"] = self.record.get(f"{name}_ms", 0.0) + 1000 * (time.perf_counter() - start)
+    def end_step(self):
+        self.last_step_end = time.perf_counter()
+        if self.enabled:
+            self.record['step_ms'] = 1000 * (self.last_step_end - self.step_start) # Host time to issue the step
+            self.pending.append((self.record, self.events))
+        self.step += 1
+        if self.profiler is not None:
+            self.profiler.step()
+    def flush(self):
+        if not self.pending:
+            return
+        if self.use_events:
+            self.pending[-1][1][-1][2].synchronize() # Wait for the last recorded event only
+        with open(self.trace_file, 'a') as f:
+            for record, events in self.pending:
+                for name, start, end in events:
+                    record[f"{name}_ms"] = record.get(f"{name}_ms", 0.0) + start.elapsed_time(end)
+                for phase in self.totals:
+                    self.totals[phase] += record.get(f"{phase}_ms", 0.0)
+                f.write(json.dumps(record) + "\n")
+        self.num_steps += len(self.pending)
+        self.pending = []
+    def summary(self):
+        return {phase: total / max(self.num_steps, 1) for phase, total in self.totals.items()}
+    def close(self):
+        if self.enabled:
+            self.flush()
+            print("Mean step time breakdown (ms): " + " | ".join(f"{phase} {ms:.2f}" for phase, ms in self.summary().items()))
+        if self.profiler is not None:
+            self.profiler.stop()
+
+
 train_accuracies = []
 train_losses = []
-def train(model: nn.Module, criterion: nn.modules.loss._Loss, optimizer: torch.optim.Optimizer, train_loader: torch.utils.data.DataLoader, epoch: int = 0, alpha: float = 0.4) -> List:
-    model.to(device)
+train_throughputs = []
+def mixed_criterion(criterion, outputs, targets_a, targets_b, lam):
+    # lam * criterion(outputs, targets_a) + (1 - lam) * criterion(outputs, targets_b) with one lambda per sample, as a single soft-target loss
+    lam = lam.view(-1, 1)
+    soft_targets = lam * F.one_hot(targets_a, outputs.size(1)) + (1 - lam) * F.one_hot(targets_b, outputs.size(1))
+    return criterion(outputs, soft_targets)
+
+def train(model: nn.Module, criterion: nn.modules.loss._Loss, optimizer: torch.optim.Optimizer, train_loader: torch.utils.data.DataLoader, epoch: int = 0, alpha: float = 0.4, augmentation: BatchAugmentation = None, accumulation_steps: int = None,
+          scaler: torch.amp.GradScaler = None, checkpoint_manager: CheckpointManager = None, start_batch: int = 0, epoch_totals: Dict = None) -> List:
+    accumulation_steps = grad_accumulation_steps if accumulation_steps is None else accumulation_steps
+    model_to_device(model)
     model.train()
-    scaler = torch.amp.GradScaler(init_scale=2.**16, device='cuda')
-    total_loss = 0.0
-    total_correct, total_samples = 0, 0
-    for batch_idx, (images, targets) in enumerate(train_loader):
-        images, targets = images.to(device), targets.to(device)
-        # Randomly pick between CutMix or MixUp
-        if np.random.rand() < 0.5:
-            mixed_images, targets_a, targets_b, lam = cutmix_data(images, targets, alpha=alpha)
-        else:
-            mixed_images, targets_a, targets_b, lam = mixup_data(images, targets, alpha=alpha)
-        optimizer.zero_grad()
-        with torch.amp.autocast(device_type='cuda'):
-            outputs = model(mixed_images)
-            loss = lam * criterion(outputs, targets_a) + (1 - lam) * criterion(outputs, targets_b)
-        scaler.scale(loss).backward()
-        scaler.step(optimizer)
-        scaler.update()
-        # Calculate accuracy for both sets of targets
-        _, predicted = torch.max(outputs, 1)
-        accuracy_a = (predicted == targets_a).float().sum().item()
-        accuracy_b = (predicted == targets_b).float().sum().item()
-        batch_accuracy = lam * (accuracy_a / len(targets_a)) + (1 - lam) * (accuracy_b / len(targets_b))
-        total_loss += loss.item()
-        total_correct += (lam * accuracy_a + (1 - lam) * accuracy_b)
-        total_samples += len(targets)
-        if batch_idx % (len(train_loader) // 9) == 0:  # Print 9 times per epoch
-            print(f'Epoch {epoch}: [{batch_idx * len(images)}/{len(train_loader.dataset)}] Train Loss: {loss.item():.3f} | Train Accuracy: {100 * batch_accuracy:.3f}%')
-    avg_loss = total_loss / len(train_loader)
+    if scaler is None:
+        scaler = torch.amp.GradScaler(init_scale=2.**16, device=device.type, enabled=device.type == 'cuda')
+    # Only profile a Chrome trace window in the first epoch
+    profiler = StepProfiler(epoch=epoch, chrome_trace_dir=chrome_trace_dir if epoch == 0 else "")
+    total_loss = torch.zeros((), device=device)
+    total_correct = torch.zeros((), device=device)
+    total_samples = 0
+    # Early-exit heads are trained jointly with the final head
+    base_model = model.module if isinstance(model, DistributedDataParallel) else model
+    joint_exits = len(getattr(base_model, 'exit_heads', ())) > 0
+    if epoch_totals is not None and is_main_process: # Resuming mid-epoch: the checkpoint holds the totals of all processes so far
+        total_loss += epoch_totals['loss']
+        total_correct += epoch_totals['correct']
+        total_samples = int(epoch_totals['samples'])
+    if isinstance(train_loader.sampler, ResumableSampler):
+        train_loader.sampler.set_epoch(epoch, start_batch * train_loader.batch_size) # Reshuffle every epoch, skipping the batches already trained on
+    num_batches = start_batch + len(train_loader)
+    log_interval = max(num_batches // 9, 1) # Print 9 times per epoch
+    optimizer.zero_grad()
+    start = time.perf_counter()
+    for batch_idx, (images, targets) in enumerate(train_loader, start=start_batch):
+        # Micro-batches of a group share one optimizer step; the last group of the epoch may be shorter
+        group_start = batch_idx - batch_idx % accumulation_steps
+        group_size = min(accumulation_steps, num_batches - group_start)
+        optimizer_step = batch_idx == group_start + group_size - 1
+        profiler.begin_step()
+        with profiler.phase('h2d'):
+            images, targets = to_device(images), targets.to(device, non_blocking=True)
+        with profiler.phase('augmentation'):
+            if augmentation is not None: # uint8 batches: augment, normalize and mix on the device
+                mixed_images, targets_a, targets_b, lam = augmentation(images, targets)
+            # Randomly pick between CutMix or MixUp
+            elif np.random.rand() < 0.5:
+                mixed_images, targets_a, targets_b, lam = cutmix_data(images, targets, alpha=alpha)
+            else:
+                mixed_images, targets_a, targets_b, lam = mixup_data(images, targets, alpha=alpha)
+        # Gradients are only all-reduced between processes on the micro-batch that steps the optimizer
+        with model.no_sync() if isinstance(model, DistributedDataParallel) and not optimizer_step else nullcontext():
+            with profiler.phase('forward'):
+                with autocast():
+                    outputs = model(mixed_images)
+                    exit_outputs = base_model.exit_outputs if joint_exits else []
+                    loss = mixed_criterion(criterion, outputs, targets_a, targets_b, lam) # Recorded loss and accuracy are those of the final head
+                    exit_loss = sum(mixed_criterion(criterion, exit_output, targets_a, targets_b, lam) for exit_output in exit_outputs) * (exit_loss_weight / len(exit_outputs)) if exit_outputs else 0
+            with profiler.phase('backward'):
+                scaler.scale((loss + exit_loss) / group_size).backward()
+        if optimizer_step:
+            with profiler.phase('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+        with profiler.phase('metrics'):
+            # Calculate accuracy for both sets of targets, without leaving the device
+            predicted = outputs.argmax(1)
+            correct = lam * (predicted == targets_a).float() + (1 - lam) * (predicted == targets_b).float()
+            total_loss += loss.detach().float()
+            total_correct += correct.sum()
+            total_samples += len(targets)
+        # Checkpoint snapshots and logging syncs belong to this step, not to the next step's data wait
+        if checkpoint_manager is not None and checkpoint_every_steps > 0 and optimizer_step and (batch_idx + 1) % (checkpoint_every_steps * accumulation_steps) == 0 and batch_idx + 1 < num_batches:
+            with profiler.phase('checkpoint', host=True):
+                loss_sum, correct_sum, samples_sum = reduce_metrics(total_loss, total_correct, total_samples)
+                checkpoint_manager.save(epoch, batch_idx + 1, epoch_totals={'loss': loss_sum, 'correct': correct_sum, 'samples': samples_sum})
+        if batch_idx % log_interval == 0:
+            with profiler.phase('log', host=True):
+                print(f'Epoch {epoch}: [{batch_idx * len(images)}/{len(train_loader.dataset)}] Train Loss: {loss.item():.3f} | Train Accuracy: {100 * correct.mean().item():.3f}%')
+                profiler.flush()
+        profiler.end_step()
+    elapsed = time.perf_counter() - start
+    total_loss, total_correct, total_samples, num_batches = reduce_metrics(total_loss, total_correct, total_samples, num_batches)
+    avg_loss = total_loss / num_batches
     avg_accuracy = 100 * (total_correct / total_samples)
+    throughput = (total_samples - (epoch_totals['samples'] if epoch_totals is not None else 0)) / elapsed
+    profiler.close()
     train_losses.append(avg_loss) # Record training losses
     train_accuracies.append(avg_accuracy) # Record training accuracies
+    train_throughputs.append(throughput) # Record training throughput
     print('---------------------------------------- --------------------------')
-    print(f'Train Result for Epoch {epoch}: Avg Train Loss: {avg_loss:.3f} | Avg Train Accuracy: {avg_accuracy:.3f}%')
+    print(f'Train Result for Epoch {epoch}: Avg Train Loss: {avg_loss:.3f} | Avg Train Accuracy: {avg_accuracy:.3f}% | {throughput:.1f} samples/s')
 
 test_accuracies = []
 test_losses = []
-def test(model: nn.Module, criterion: nn.modules.loss._Loss, test_loader: torch.utils.data.DataLoader, epoch: int=0) -> Dict:
-    model.to(device)
+def test(model: nn.Module, criterion: nn.modules.loss._Loss, test_loader: torch.utils.data.DataLoader, epoch: int=0, augmentation: BatchAugmentation = None) -> Dict:
+    model_to_device(model)
     model.eval()
-    test_loss, correct = 0, 0
+    test_loss = torch.zeros((), device=device)
+    correct = torch.zeros((), dtype=torch.long, device=device)
     total_num = len(test_loader.dataset)
-    with torch.no_grad():
+    with torch.no_grad(), autocast():
         for images, targets in test_loader:
-            images, targets = images.to(device), targets.to(device)
+            images, targets = to_device(images), targets.to(device, non_blocking=True)
+            if augmentation is not None: # uint8 batches only need normalizing
+                images = augmentation(images)
             outputs = model(images)
-            test_loss += criterion(outputs, targets).item() * len(images)
-            correct += (outputs.argmax(1) == targets).sum().item()
+            test_loss += criterion(outputs, targets).float() * len(images)
+            correct += (outputs.argmax(1) == targets).sum()
+    # Single copy to the host per evaluation, summed over all processes
+    test_loss, correct, total_num = reduce_metrics(test_loss, correct, total_num)
     avg_loss = test_loss / total_num
     accuracy = 100 * (correct / total_num)
     test_losses.append(avg_loss) # Record testing losses
     test_accuracies.append(accuracy) # Record testing accuracies
     print(f"Test Result for Epoch {epoch}: Avg Test Loss: {avg_loss:.3f} | Avg Test Accuracy: {accuracy:.3f}%")
 
-"""# Step 9: Data Preparation and Visualization for CIFAR10 Dataset
+"""# Benchmarking Throughput
+`python ViT.py benchmark` measures inference and training throughput of the ViT on synthetic images and exit. This is useful to size CPU nodes (set `device_preference = 'cpu'` and vary `cpu_threads`) without downloading any dataset.
+"""
 
-Here, I used the same setup process as I did in Assignment 3, except I am adding more image augmentation techniques to transforms.Compose(). This includes randomly cropping and resizing, random horizontal flipping, and random color jitter.
+def benchmark_throughput(model, batch_sizes=(1, 8, 32), num_warmup=2, num_iters=5):
+    model_to_device(model)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(model.parameters(), lr=1e-4)
+    scaler = torch.amp.GradScaler(device=device.type, enabled=device.type == 'cuda')
+    in_channels = model.conv_projection.in_channels
+    results = []
+    for batch_size in batch_sizes:
+        images = to_device(torch.randn(batch_size, in_channels, model.image_size, model.image_size))
+        targets = torch.randint(0, model.mlp_head[-1].out_features, (batch_size,), device=device)
+        # Inference
+        model.eval()
+        with torch.no_grad(), autocast():
+            for i in range(num_warmup + num_iters):
+                if i == num_warmup:
+                    synchronize()
+                    start = time.perf_counter()
+                model(images)
+        synchronize()
+        inference_time = (time.perf_counter() - start) / num_iters
+        # Training step (forward, backward and optimizer step)
+        model.train()
+        for i in range(num_warmup + num_iters):
+            if i == num_warmup:
+                synchronize()
+                start = time.perf_counter()
+            optimizer.zero_grad()
+            with autocast():
+                loss = criterion(model(images), targets)
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+        synchronize()
+        train_time = (time.perf_counter() - start) / num_iters
+        results.append({'image_size': model.image_size, 'patch_size': model.patch_size, 'batch_size': batch_size, 'inference_ms': 1000 * inference_time, 'inference_images_per_sec': batch_size / inference_time,
+                        'train_ms': 1000 * train_time, 'train_images_per_sec': batch_size / train_time})
+    return results
 
-The rest of the code is from Assignment 3.
-"""
-if dataset == 'CIFAR10':
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.RandomResizedCrop(224, scale=(0.8, 1.0)),
+def memory_workload(kind, **params):
+    # The workloads whose peak memory is reported, built by name so that peak_memory_mb can rebuild them in a fresh process
+    if kind == 'attention':
+        attention = set_attention_backend(MultiHeadSelfAttention(params['embedding_dim'], params['num_heads']).to(device).eval(), params['backend'])
+        input_tensor = torch.randn(params['batch_size'], params['seq_len'], params['embedding_dim'], device=device)
+        def run():
+            with torch.no_grad(), autocast():
+                attention(input_tensor)
+        return run
+    if kind == 'train_step':
+        # One optimizer step of the Step 10 model: (activation checkpointing, micro-batch size, accumulation steps)
+        micro_batch_size, accumulation_steps = params['micro_batch_size'], params['accumulation_steps']
+        model = model_to_device(VisionTransformer(d_model, num_classes=10, num_heads=8, num_layers=8, mlp_dim=2048, image_size=image_size, patch_size=patch_size,
+                                                  in_channels=in_channels, activation_checkpointing=params['activation_checkpointing'])).train()
+        criterion = nn.CrossEntropyLoss()
+        optimizer = optim.AdamW(model.parameters(), lr=1e-4)
+        scaler = torch.amp.GradScaler(device=device.type, enabled=device.type == 'cuda')
+        images = to_device(torch.randn(micro_batch_size, in_channels, image_size, image_size))
+        targets = torch.randint(0, 10, (micro_batch_size,), device=device)
+        def step():
+            for _ in range(accumulation_steps):
+                with autocast():
+                    loss = criterion(model(images), targets)
+                scaler.scale(loss / accumulation_steps).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+        return step
+    raise ValueError(f"Unknown memory workload '{kind}'")
+
+def benchmark_settings():
+    # The settings a benchmark subprocess needs to measure the same configuration as this process
+    return {'dataset': dataset, 'device_preference': device.type, 'native_resolution': native_resolution, 'cpu_threads': cpu_threads,
+            'cpu_bf16': cpu_bf16, 'channels_last': channels_last, 'attention_backend': attention_backend}
+
+def process_peak_memory_mb(kind, params):
+    # Peak RSS growth of this (fresh) process while building the workload and running it twice
+    import psutil
+    baseline = psutil.Process().memory_info().rss
+    run = memory_workload(kind, **params)
+    run()
+    run()
+    if sys.platform == 'win32':
+        peak = psutil.Process().memory_info().peak_wset
+    else:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024) # Bytes on macOS, KiB on Linux
+    return (peak - baseline) / 2**20
+
+def peak_memory_mb(kind, params):
+    # Peak memory of building and running a memory_workload, including its parameters, optimizer state and inputs.
+    # On GPU the allocator statistics are exact. On CPU the process RSS only grows when the allocator needs more memory than it ever held,
+    # so in a long-lived process the result would depend on what ran before; every workload is measured in a fresh process instead.
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+        run = memory_workload(kind, **params)
+        run()
+        run()
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - baseline
+        del run
+        return peak / 2**20
+    module_dir, module_name = os.path.split(os.path.abspath(__file__))
+    module_name = os.path.splitext(module_name)[0]
+    code = (f"import sys, json; sys.path.insert(0, {module_dir!r}); import {module_name} as vit; vit.configure(**json.loads({json.dumps(benchmark_settings())!r})); vit.init_runtime(); "
+            f"print(json.dumps(vit.process_peak_memory_mb({kind!r}, json.loads({json.dumps(params)!r}))))")
+    completed = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(f"Peak memory measurement of '{kind}' {params} failed: {completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else completed.returncode}")
+        return float('nan')
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def compare_attention_backends(seq_lens=(197, 577, 1025), batch_size=8, embedding_dim=512, num_heads=8, num_iters=5):
+    attention = MultiHeadSelfAttention(embedding_dim, num_heads).to(device).eval()
+    # Checkpoints with separate query/key/value layers must load into the fused projection
+    legacy_state_dict = {f"{name}.{param}": tensor for param in ('weight', 'bias')
+                         for name, tensor in zip(('query', 'key', 'value'), attention.qkv.state_dict()[param].chunk(3, dim=0))}
+    legacy_state_dict.update({f"out.{param}": tensor for param, tensor in attention.out.state_dict().items()})
+    reloaded = MultiHeadSelfAttention(embedding_dim, num_heads).to(device)
+    reloaded.load_state_dict(legacy_state_dict)
+    assert torch.equal(reloaded.qkv.weight, attention.qkv.weight) and torch.equal(reloaded.qkv.bias, attention.qkv.bias)
+    results = []
+    for seq_len in seq_lens:
+        input_tensor = torch.randn(batch_size, seq_len, embedding_dim, device=device)
+        with torch.no_grad():
+            # Numerical equivalence in float32
+            reference_output = set_attention_backend(attention, 'reference')(input_tensor)
+            sdpa_output = set_attention_backend(attention, 'sdpa')(input_tensor)
+            max_abs_error = (reference_output - sdpa_output).abs().max().item()
+            assert torch.allclose(reference_output, sdpa_output, atol=1e-4, rtol=1e-4), f"Attention backends disagree at seq_len={seq_len} (max abs error {max_abs_error:.2e})"
+            for backend in ATTENTION_BACKENDS:
+                set_attention_backend(attention, backend)
+                def run():
+                    with autocast():
+                        for _ in range(num_iters):
+                            attention(input_tensor)
+                run() # Warmup
+                synchronize()
+                start = time.perf_counter()
+                run()
+                synchronize()
+                latency = 1000 * (time.perf_counter() - start) / num_iters
+                peak_memory = peak_memory_mb('attention', {'seq_len': seq_len, 'batch_size': batch_size, 'embedding_dim': embedding_dim, 'num_heads': num_heads, 'backend': backend})
+                results.append({'seq_len': seq_len, 'backend': backend, 'latency_ms': latency, 'peak_memory_mb': peak_memory, 'max_abs_error': max_abs_error})
+    return results
+
+def print_attention_report(results):
+    print(f"Attention backends on {device.type.upper()} (outputs match the reference within 1e-4)")
+    print(f"{'Seq len':>7} | {'Backend':>9} | {'Latency ms':>10} | {'Peak MB':>8} | {'Max abs err':>11}")
+    for r in results:
+        print(f"{r['seq_len']:>7} | {r['backend']:>9} | {r['latency_ms']:>10.2f} | {r['peak_memory_mb']:>8.1f} | {r['max_abs_error']:>11.2e}")
+
+def benchmark_positional_encoding(configs=((512, 224), (1024, 384), (1024, 1024)), patch_size=16):
+    results = []
+    for embedding_dim, image_size in configs:
+        max_len = (image_size // patch_size) ** 2 + 1
+        # Original Python double loop, for reference
+        start = time.perf_counter()
+        loop_encoding = np.zeros((max_len, embedding_dim))
+        for pos in range(max_len):
+            for i in range(0, embedding_dim, 2):
+                loop_encoding[pos, i] = np.sin(pos / (10000 ** (i / embedding_dim)))
+                if i + 1 < embedding_dim:
+                    loop_encoding[pos, i + 1] = np.cos(pos / (10000 ** (i / embedding_dim)))
+        loop_time = time.perf_counter() - start
+        _positional_encoding_cache.clear()
+        start = time.perf_counter()
+        encoding = get_positional_encoding(embedding_dim, max_len)
+        vectorized_time = time.perf_counter() - start
+        assert np.allclose(encoding.numpy(), loop_encoding, atol=1e-6)
+        start = time.perf_counter()
+        get_positional_encoding(embedding_dim, max_len)
+        cached_time = time.perf_counter() - start
+        start = time.perf_counter()
+        VisionTransformer(embedding_dim, num_classes=10, num_heads=8, num_layers=2, mlp_dim=4 * embedding_dim, image_size=image_size, patch_size=patch_size, in_channels=in_channels)
+        construction_time = time.perf_counter() - start
+        results.append({'d_model': embedding_dim, 'max_len': max_len, 'loop_ms': 1000 * loop_time, 'vectorized_ms': 1000 * vectorized_time,
+                        'cached_ms': 1000 * cached_time, 'model_construction_ms': 1000 * construction_time})
+    return results
+
+def print_positional_encoding_report(results):
+    print("Positional encoding table and model construction time (2-layer ViT, table already cached)")
+    print(f"{'d_model':>7} | {'max_len':>7} | {'Loop ms':>9} | {'Vectorized ms':>13} | {'Cached ms':>9} | {'Model ms':>9}")
+    for r in results:
+        print(f"{r['d_model']:>7} | {r['max_len']:>7} | {r['loop_ms']:>9.1f} | {r['vectorized_ms']:>13.2f} | {r['cached_ms']:>9.3f} | {r['model_construction_ms']:>9.1f}")
+
+def benchmark_augmentation(batch_size=32, image_size=224, num_iters=5):
+    import torchvision.transforms as transforms
+    images = torch.randint(0, 256, (batch_size, 3, image_size, image_size), dtype=torch.uint8)
+    targets = torch.randint(0, 10, (batch_size,))
+    # Before: torchvision transforms one image at a time, then a batched MixUp
+    per_sample_transform = transforms.Compose([
+        transforms.RandomResizedCrop(image_size, scale=(0.8, 1.0), antialias=True),
         transforms.RandomHorizontalFlip(),
         transforms.RandomRotation(10),
-        transforms.ToTensor(),
+        transforms.ConvertImageDtype(torch.float32),
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
     ])
-    train_dataset = datasets.CIFAR10('data', train=True, download=True, transform=transform)
-    test_dataset = datasets.CIFAR10('data', train=False, download=True, transform=transform)
-if dataset == 'MNIST':
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        mixup_data(to_device(torch.stack([per_sample_transform(image) for image in images])), targets.to(device))
+    synchronize()
+    per_sample_time = (time.perf_counter() - start) / num_iters
+    # After: uint8 batch on the device, augmented in a few kernels
+    augmentation = BatchAugmentation(image_size, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), seed=0)
+    augmentation(to_device(images), targets.to(device)) # Warmup
+    synchronize()
+    start = time.perf_counter()
+    for _ in range(num_iters):
+        augmentation(to_device(images), targets.to(device))
+    synchronize()
+    batched_time = (time.perf_counter() - start) / num_iters
+    return {'batch_size': batch_size, 'per_sample_ms': 1000 * per_sample_time, 'batched_ms': 1000 * batched_time}
+
+def benchmark_memory(configs=((False, 32, 1), (True, 32, 1), (False, 8, 4), (True, 8, 4)), num_iters=3):
+    # Peak memory and time of one optimizer step at the same effective batch size, for (activation checkpointing, micro-batch size, accumulation steps)
+    results = []
+    for checkpointing, micro_batch_size, accumulation_steps in configs:
+        params = {'activation_checkpointing': checkpointing, 'micro_batch_size': micro_batch_size, 'accumulation_steps': accumulation_steps}
+        step = memory_workload('train_step', **params)
+        step() # Warmup, also allocates the optimizer state
+        synchronize()
+        start = time.perf_counter()
+        for _ in range(num_iters):
+            step()
+        synchronize()
+        step_time = (time.perf_counter() - start) / num_iters
+        del step # Frees the model before the memory of the next configuration is measured
+        results.append(dict(params, peak_memory_mb=peak_memory_mb('train_step', params), step_ms=1000 * step_time))
+    return results
+
+def print_memory_report(results):
+    print(f"Peak memory vs. step time at {image_size}px, effective batch size {results[0]['micro_batch_size'] * results[0]['accumulation_steps']}, on {device.type.upper()}")
+    print(f"{'Checkpointing':>13} | {'Micro-batch':>11} | {'Accumulation':>12} | {'Peak MB':>8} | {'Step ms':>8}")
+    for r in results:
+        print(f"{str(r['activation_checkpointing']):>13} | {r['micro_batch_size']:>11} | {r['accumulation_steps']:>12} | {r['peak_memory_mb']:>8.1f} | {r['step_ms']:>8.1f}")
+
+def benchmark_data_parallel(batch_size=32, num_warmup=2, num_iters=5):
+    # Runs in every torchrun process: synthetic DistributedDataParallel training steps, in samples/sec over all processes
+    model = model_to_device(VisionTransformer(d_model, num_classes=10, num_heads=8, num_layers=8, mlp_dim=2048, image_size=image_size, patch_size=patch_size, in_channels=in_channels))
+    ddp_model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None, broadcast_buffers=False)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(model.parameters(), lr=1e-4)
+    scaler = torch.amp.GradScaler(device=device.type, enabled=device.type == 'cuda')
+    images = to_device(torch.randn(batch_size, in_channels, image_size, image_size))
+    targets = torch.randint(0, 10, (batch_size,), device=device)
+    for i in range(num_warmup + num_iters):
+        if i == num_warmup:
+            synchronize()
+            dist.barrier()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        with autocast():
+            loss = criterion(ddp_model(images), targets)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    synchronize()
+    elapsed = torch.tensor(time.perf_counter() - start, dtype=torch.float64, device=device)
+    dist.all_reduce(elapsed, op=dist.ReduceOp.MAX) # The slowest process sets the pace
+    return world_size * batch_size * num_iters / elapsed.item()
+
+def benchmark_scaling_efficiency(process_counts=(1, 2, 4)):
+    # Launches this script under torchrun once per process count; each run reports its throughput through a temporary file
+    if device.type == 'cuda':
+        process_counts = [n for n in process_counts if n <= torch.cuda.device_count()]
+    results = []
+    for num_processes in process_counts:
+        with tempfile.TemporaryDirectory() as result_dir:
+            result_path = os.path.join(result_dir, 'result.json')
+            env = dict(os.environ, VIT_SCALING_BENCHMARK_RESULT=result_path)
+            if device.type == 'cpu': # Split the cores between the processes
+                env['OMP_NUM_THREADS'] = str(max((os.cpu_count() or 1) // num_processes, 1))
+            # The children measure the same configuration as this process
+            options = ['--device', device.type, '--dataset', dataset] + (['--native-resolution'] if native_resolution else [])
+            subprocess.run([sys.executable, '-m', 'torch.distributed.run', '--standalone', f'--nproc_per_node={num_processes}', os.path.abspath(__file__), 'benchmark'] + options, env=env)
+            if not os.path.exists(result_path):
+                print(f"Scaling benchmark with {num_processes} processes failed")
+                continue
+            with open(result_path) as f:
+                results.append({'processes': num_processes, 'samples_per_sec': json.load(f)['samples_per_sec']})
+    if results:
+        single_process = results[0]['samples_per_sec'] / results[0]['processes']
+        for r in results:
+            r['efficiency'] = r['samples_per_sec'] / (r['processes'] * single_process)
+    return results
+
+def print_scaling_report(results):
+    print(f"Data-parallel scaling on {device.type.upper()} ({'nccl' if device.type == 'cuda' else 'gloo'} backend), batch size 32 per process")
+    print(f"{'Processes':>9} | {'Samples/s':>9} | {'Efficiency':>10}")
+    for r in results:
+        print(f"{r['processes']:>9} | {r['samples_per_sec']:>9.1f} | {100 * r['efficiency']:>9.1f}%")
+
+def print_throughput_report(results):
+    print(f"Throughput at {results[0]['image_size']}px with {results[0]['patch_size']}px patches ({(results[0]['image_size'] // results[0]['patch_size']) ** 2 + 1} tokens) on {device.type.upper()}" + (f" ({torch.get_num_threads()} intra-op / {torch.get_num_interop_threads()} inter-op threads, bfloat16 autocast: {cpu_bf16}, channels-last: {channels_last})" if device.type == 'cpu' else ""))
+    print(f"{'Batch':>6} | {'Infer ms/batch':>14} | {'Infer img/s':>11} | {'Train ms/step':>13} | {'Train img/s':>11}")
+    for r in results:
+        print(f"{r['batch_size']:>6} | {r['inference_ms']:>14.1f} | {r['inference_images_per_sec']:>11.1f} | {r['train_ms']:>13.1f} | {r['train_images_per_sec']:>11.1f}")
+
+def benchmark_cold_start(num_images=8, num_runs=3):
+    # Wall-clock time of fresh processes: importing this file, importing it plus the modules it used to import eagerly (matplotlib and the torchvision datasets), and a full `predict` command
+    module_dir, module_name = os.path.split(os.path.abspath(__file__))
+    module_name = os.path.splitext(module_name)[0]
+    with tempfile.TemporaryDirectory() as work_dir:
+        image_dir = os.path.join(work_dir, 'images')
+        os.makedirs(image_dir)
+        for i in range(num_images):
+            Image.fromarray(np.random.randint(0, 256, (native_image_size, native_image_size, 3), dtype=np.uint8)).save(os.path.join(image_dir, f"{i}.png"))
+        weights_path = os.path.join(work_dir, 'model.safetensors')
+        save_weights(build_model().state_dict(), weights_path)
+        commands = {
+            'import': [sys.executable, '-c', f"import sys; sys.path.insert(0, {module_dir!r}); import {module_name}"],
+            'import + matplotlib/torchvision datasets': [sys.executable, '-c', f"import sys; sys.path.insert(0, {module_dir!r}); import {module_name}, matplotlib.pyplot, torchvision.datasets"],
+            'predict': [sys.executable, os.path.abspath(__file__), 'predict', image_dir, '--checkpoint', weights_path, '--output', os.path.join(work_dir, 'predictions.csv'),
+                        '--no-plot', '--dataset', dataset, '--device', device_preference] + (['--native-resolution'] if native_resolution else []),
+        }
+        results = []
+        for name, command in commands.items():
+            times = []
+            for _ in range(num_runs):
+                start = time.perf_counter()
+                completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+            results.append({'command': name, 'seconds': float(np.median(times)), 'ok': completed.returncode == 0})
+    return results
+
+def print_cold_start_report(results):
+    print("Cold start (median wall-clock time of a fresh process)")
+    for r in results:
+        print(f"{r['command']:>40} | {r['seconds']:>6.2f} s" + ("" if r['ok'] else " (failed)"))
+
+def run_benchmark():
+    if distributed: # One process of a scaling benchmark run
+        samples_per_sec = benchmark_data_parallel()
+        if is_main_process and os.environ.get('VIT_SCALING_BENCHMARK_RESULT'):
+            with open(os.environ['VIT_SCALING_BENCHMARK_RESULT'], 'w') as f:
+                json.dump({'samples_per_sec': samples_per_sec}, f)
+        print(f"Data-parallel throughput with {world_size} processes: {samples_per_sec:.1f} samples/s")
+        dist.destroy_process_group()
+        return
+    # Same configuration as the model defined in Step 10, upscaled to 224px and at native resolution
+    for size, patch in ((224, 16), (native_image_size, 4)):
+        print_throughput_report(benchmark_throughput(VisionTransformer(d_model, num_classes=10, num_heads=8, num_layers=8, mlp_dim=2048, image_size=size, patch_size=patch, in_channels=in_channels)))
+    print_attention_report(compare_attention_backends())
+    print_positional_encoding_report(benchmark_positional_encoding())
+    print_memory_report(benchmark_memory())
+    augmentation_result = benchmark_augmentation()
+    print(f"Augmentation of a batch of {augmentation_result['batch_size']}: {augmentation_result['per_sample_ms']:.1f} ms per-sample -> {augmentation_result['batched_ms']:.1f} ms batched on {device.type.upper()}")
+    print_cold_start_report(benchmark_cold_start())
+    print_knn_report(benchmark_knn())
+    if benchmark_scaling:
+        print_scaling_report(benchmark_scaling_efficiency())
+    if benchmark_data:
+        benchmark_data_loading()
+
+"""# Benchmark Suite
+`python ViT.py benchmark --suite` times the model components and the pipelines around them on synthetic data, with fixed seeds and shapes, so that two runs on the same machine are comparable: positional encoding construction, attention and encoder block forward and forward/backward across batch sizes and sequence lengths, the patch convolution, MixUp/CutMix, DataLoader throughput from a synthetic uint8 cache, and end-to-end training steps and inference. Every case reports the median and interquartile range of its per-iteration times. The results and the environment they were measured in are written to `benchmark_results_file` as JSON.
+
+With `--baseline` (an earlier results file), every case is compared with its baseline median and the command exits with status 1 if any case got slower by more than `benchmark_regression_threshold`, so it can gate a CI job. Use `--device cpu` and a fixed `cpu_threads` for results that are comparable across machines of the same type. `--quick` runs fewer shapes and iterations.
+"""
+
+BENCHMARK_SUITE_VERSION = 1
+
+def time_iterations(fn, num_warmup=3, num_iters=10):
+    # Per-iteration wall-clock times of fn in milliseconds, after warmup
+    for _ in range(num_warmup):
+        fn()
+    synchronize()
+    timings = []
+    for _ in range(num_iters):
+        start = time.perf_counter()
+        fn()
+        synchronize()
+        timings.append(1000 * (time.perf_counter() - start))
+    return timings
+
+def benchmark_case_key(name, params):
+    return name + '[' + ','.join(f"{key}={value}" for key, value in params.items()) + ']'
+
+def benchmark_environment(quick):
+    return {'torch': torch.__version__, 'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'num_threads': torch.get_num_threads(), 'device': device.type, 'cpu_bf16': cpu_bf16, 'channels_last': channels_last, 'quick': quick}
+
+def benchmark_suite_cases(quick=False):
+    # Yields (name, params, fn, items per call) for every case; items per call turns the median into a throughput
+    batch_sizes, seq_lens = ((1, 8), (65,)) if quick else ((1, 8, 32), (65, 197))
+    for embedding_dim, max_len in ((512, 65), (512, 197)) if quick else ((512, 65), (512, 197), (1024, 577)):
+        def build_encoding(embedding_dim=embedding_dim, max_len=max_len):
+            _positional_encoding_cache.clear()
+            PositionalEncoding(embedding_dim, max_len)
+        yield 'positional_encoding', {'d_model': embedding_dim, 'max_len': max_len}, build_encoding, None
+    attention = MultiHeadSelfAttention(d_model, num_heads).to(device)
+    block = TransformerEncoderBlock(d_model, num_heads, mlp_dim).to(device)
+    for module_name, module in (('attention', attention), ('encoder_block', block)):
+        for batch_size, seq_len in itertools.product(batch_sizes, seq_lens):
+            inputs = torch.randn(batch_size, seq_len, d_model, device=device)
+            def forward(module=module, inputs=inputs):
+                with torch.no_grad(), autocast():
+                    module(inputs)
+            def forward_backward(module=module, inputs=inputs):
+                module.zero_grad(set_to_none=True)
+                with autocast():
+                    output = module(inputs)
+                output.float().sum().backward()
+            params = {'batch_size': batch_size, 'seq_len': seq_len, 'd_model': d_model}
+            yield f"{module_name}_forward", params, forward, batch_size
+            yield f"{module_name}_forward_backward", params, forward_backward, batch_size
+    for size, patch in ((native_image_size, 4), (224, 16)):
+        projection = model_to_device(nn.Conv2d(in_channels, d_model, kernel_size=patch, stride=patch)).eval()
+        for batch_size in (1, 32):
+            images = to_device(torch.randn(batch_size, in_channels, size, size))
+            def project(projection=projection, images=images):
+                with torch.no_grad(), autocast():
+                    projection(images)
+            yield 'conv_projection', {'batch_size': batch_size, 'image_size': size, 'patch_size': patch}, project, batch_size
+    images, targets = to_device(torch.randn(32, in_channels, 224, 224)), torch.randint(0, num_classes, (32,), device=device)
+    rng = np.random.default_rng(0)
+    yield 'mixup_data', {'batch_size': 32, 'image_size': 224}, lambda: mixup_data(images, targets, rng=rng), 32
+    yield 'cutmix_data', {'batch_size': 32, 'image_size': 224}, lambda: cutmix_data(images, targets, rng=rng), 32
+    # End to end at native resolution, with the model of Step 10
+    model = model_to_device(VisionTransformer(d_model, num_classes, num_heads, num_layers, mlp_dim, native_image_size, 4, in_channels))
+    augmentation = BatchAugmentation(native_image_size, (0.5,) * in_channels, (0.5,) * in_channels, seed=0)
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(model.parameters(), lr=1e-4)
+    scaler = torch.amp.GradScaler(device=device.type, enabled=device.type == 'cuda')
+    uint8_images = to_device(torch.randint(0, 256, (32, in_channels, native_image_size, native_image_size), dtype=torch.uint8))
+    def train_step():
+        # One step of train(): augmentation and mixing on the device, forward, backward and optimizer step
+        model.train()
+        mixed_images, targets_a, targets_b, lam = augmentation(uint8_images, targets)
+        with autocast():
+            loss = mixed_criterion(criterion, model(mixed_images), targets_a, targets_b, lam)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+    yield 'train_step', {'batch_size': 32, 'image_size': native_image_size, 'patch_size': 4}, train_step, 32
+    for batch_size in (1, 32):
+        normalized = augmentation.normalize(uint8_images[:batch_size])
+        def infer(normalized=normalized):
+            model.eval()
+            with torch.no_grad(), autocast():
+                model(normalized).argmax(1)
+        yield 'inference', {'batch_size': batch_size, 'image_size': native_image_size, 'patch_size': 4}, infer, batch_size
+
+def benchmark_suite_data_loading(directory, quick=False, num_images=1024):
+    # DataLoader throughput over a synthetic uint8 cache at native resolution, in the format build_dataset_cache writes
+    num_images = 256 if quick else num_images
+    manifest = {'images': os.path.join(directory, 'images.npy'), 'labels': os.path.join(directory, 'labels.npy')}
+    np.save(manifest['images'], np.random.default_rng(0).integers(0, 256, (num_images, in_channels, native_image_size, native_image_size), dtype=np.uint8))
+    np.save(manifest['labels'], np.arange(num_images, dtype=np.int64) % num_classes)
+    for workers in sorted({0, num_workers}):
+        loader = make_loader(CachedImageDataset(manifest), shuffle=True, workers=workers)
+        def epoch(loader=loader):
+            for _ in loader:
+                pass
+        yield 'data_loader_epoch', {'num_images': num_images, 'image_size': native_image_size, 'num_workers': workers}, epoch, num_images
+
+def run_benchmark_suite(quick=False, output_file=None, baseline_file=None, threshold=None):
+    output_file = benchmark_results_file if output_file is None else output_file
+    baseline_file = benchmark_baseline_file if baseline_file is None else baseline_file
+    threshold = benchmark_regression_threshold if threshold is None else threshold
+    baseline = None
+    if baseline_file != "":
+        # The median of the 3 timings of --quick flags regressions on unchanged code, so neither side of a comparison may use it
+        if quick:
+            raise ValueError("--quick results are too noisy to compare with a baseline; run the full suite to check for regressions")
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline['environment'].get('quick'):
+            raise ValueError(f"Baseline '{baseline_file}' was measured with --quick, which is too noisy to compare against; record it with the full suite")
+    torch.manual_seed(0)
+    np.random.seed(0)
+    num_warmup, num_iters = (1, 3) if quick else (3, 10)
+    results = []
+    print(f"{'Case':<70} | {'Median ms':>10} | {'IQR ms':>8} | {'Items/s':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, params, fn, items in itertools.chain(benchmark_suite_cases(quick), benchmark_suite_data_loading(directory, quick)):
+            timings = time_iterations(fn, num_warmup, num_iters)
+            median = float(np.median(timings))
+            result = {'name': name, 'params': params, 'median_ms': median, 'iqr_ms': float(np.percentile(timings, 75) - np.percentile(timings, 25)),
+                      'min_ms': float(np.min(timings)), 'iterations': num_iters, 'items_per_sec': None if items is None else 1000 * items / median}
+            results.append(result)
+            throughput = '' if items is None else f"{result['items_per_sec']:.1f}"
+            print(f"{benchmark_case_key(name, params):<70} | {median:>10.3f} | {result['iqr_ms']:>8.3f} | {throughput:>10}")
+    report = {'version': BENCHMARK_SUITE_VERSION, 'environment': benchmark_environment(quick), 'results': results}
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark suite results saved as '{output_file}'")
+    if baseline is None:
+        return []
+    return print_regression_report(compare_benchmarks(report, baseline, threshold), baseline, report, threshold)
+
+def compare_benchmarks(report, baseline, threshold, min_delta_ms=0.05):
+    # Median of every case vs. its baseline. A change only counts if it is larger than the spread of both runs (their interquartile ranges)
+    # and than min_delta_ms, so timer noise on short or jittery cases never flags a regression.
+    baseline_results = {benchmark_case_key(r['name'], r['params']): r for r in baseline['results']}
+    comparisons = []
+    for r in report['results']:
+        key = benchmark_case_key(r['name'], r['params'])
+        if key not in baseline_results:
+            comparisons.append({'case': key, 'median_ms': r['median_ms'], 'baseline_ms': None, 'ratio': None, 'status': 'new'})
+            continue
+        baseline_ms = baseline_results[key]['median_ms']
+        ratio = r['median_ms'] / baseline_ms
+        status = 'ok'
+        noise_ms = max(min_delta_ms, r['iqr_ms'] + baseline_results[key]['iqr_ms'])
+        if abs(r['median_ms'] - baseline_ms) > noise_ms:
+            if ratio > 1 + threshold:
+                status = 'regression'
+            elif ratio < 1 / (1 + threshold):
+                status = 'improvement'
+        comparisons.append({'case': key, 'median_ms': r['median_ms'], 'baseline_ms': baseline_ms, 'ratio': ratio, 'status': status})
+    return comparisons
+
+def print_regression_report(comparisons, baseline, report, threshold):
+    # Returns the regressed cases
+    changed = {name: (baseline['environment'].get(name), value) for name, value in report['environment'].items() if baseline['environment'].get(name) != value}
+    if changed:
+        print(f"Warning: the baseline was measured in a different environment ({', '.join(f'{name}: {old} -> {new}' for name, (old, new) in changed.items())}), so timings may not be comparable")
+    print(f"Comparison with the baseline (regression threshold {100 * threshold:.0f}%)")
+    print(f"{'Case':<70} | {'Baseline ms':>11} | {'Median ms':>10} | {'Change':>7} | Status")
+    for c in comparisons:
+        baseline_ms = '' if c['baseline_ms'] is None else f"{c['baseline_ms']:.3f}"
+        change = '' if c['ratio'] is None else f"{100 * (c['ratio'] - 1):+.1f}%"
+        print(f"{c['case']:<70} | {baseline_ms:>11} | {c['median_ms']:>10.3f} | {change:>7} | {c['status']}")
+    regressions = [c for c in comparisons if c['status'] == 'regression']
+    print(f"{len(regressions)} regressions, {sum(c['status'] == 'improvement' for c in comparisons)} improvements, {sum(c['status'] == 'new' for c in comparisons)} new cases")
+    return regressions
+
+"""# Step 9: Data Preparation and Visualization for CIFAR10 Dataset
+
+Here, I used the same setup process as I did in Assignment 3, except I am adding more image augmentation techniques to transforms.Compose(). This includes randomly cropping and resizing, random horizontal flipping, and random color jitter.
+
+Decoding and resizing every sample (to 224x224 unless `native_resolution` is set) on every epoch keeps the device waiting on Python image code. Unless `dataset_cache_dir` is blank, each split is decoded once and written at its native resolution (32x32 CIFAR-10, 28x28 MNIST) to a compact uint8 memory-mapped array (plus labels and a JSON manifest whose fingerprint invalidates the cache when the source data changes). The persistent, prefetching DataLoader workers then only ship small uint8 batches, and the resize to the training resolution and the random augmentations run batched on the device (see Step 7).
+
+The rest of the code is from Assignment 3.
+"""
+DATASET_CACHE_VERSION = 2 # 2: native resolution instead of the training resolution
+
+def dataset_fingerprint(source_dataset):
+    data = source_dataset.data
+    data = data.numpy() if isinstance(data, torch.Tensor) else np.asarray(data)
+    digest = hashlib.sha256()
+    digest.update(f"{type(source_dataset).__name__}:{data.shape}:{DATASET_CACHE_VERSION}".encode())
+    digest.update(np.ascontiguousarray(data).tobytes())
+    digest.update(np.asarray(source_dataset.targets, dtype=np.int64).tobytes())
+    return digest.hexdigest()
+
+def build_dataset_cache(source_dataset, cache_prefix):
+    # source_dataset must return (PIL image, label) pairs, i.e. be built without a transform
+    manifest_path = cache_prefix + '.json'
+    fingerprint = dataset_fingerprint(source_dataset)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('fingerprint') == fingerprint and os.path.exists(manifest['images']) and os.path.exists(manifest['labels']):
+            return manifest
+    first_image = source_dataset[0][0]
+    channels, (width, height) = len(first_image.getbands()), first_image.size
+    print(f"Building dataset cache '{cache_prefix}' ({len(source_dataset)} images at {width}x{height}). This only happens once.")
+    images_path, labels_path = cache_prefix + '.images.npy', cache_prefix + '.labels.npy'
+    # Temporary files are unique per host and process, so nodes sharing the cache directory never write the same file; each rename is atomic
+    temporary = f".{platform.node()}.{os.getpid()}.tmp"
+    images = np.lib.format.open_memmap(cache_prefix + '.images' + temporary + '.npy', mode='w+', dtype=np.uint8, shape=(len(source_dataset), channels, height, width))
+    labels = np.empty(len(source_dataset), dtype=np.int64)
+    for index in range(len(source_dataset)):
+        image, label = source_dataset[index]
+        images[index] = np.asarray(image, dtype=np.uint8).reshape(height, width, channels).transpose(2, 0, 1)
+        labels[index] = label
+    images.flush()
+    del images
+    np.save(cache_prefix + '.labels' + temporary + '.npy', labels)
+    # Rename into place and write the manifest last, so an interrupted build is never mistaken for a valid cache
+    os.replace(cache_prefix + '.images' + temporary + '.npy', images_path)
+    os.replace(cache_prefix + '.labels' + temporary + '.npy', labels_path)
+    manifest = {'fingerprint': fingerprint, 'dataset': type(source_dataset).__name__, 'num_samples': len(labels), 'channels': channels,
+                'height': height, 'width': width, 'images': images_path, 'labels': labels_path}
+    with open(manifest_path + temporary, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + temporary, manifest_path)
+    return manifest
+
+class CachedImageDataset(torch.utils.data.Dataset):
+    # Reads native-resolution uint8 [channels, height, width] images from the memory-mapped cache without decoding; BatchAugmentation resizes them on the device
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.labels = np.load(manifest['labels'])
+        self.images = None
+    def __len__(self):
+        return len(self.labels)
+    def __getitem__(self, index):
+        if self.images is None: # Opened lazily so that every worker process maps the file itself
+            self.images = np.load(self.manifest['images'], mmap_mode='c')
+        return torch.from_numpy(self.images[index]), int(self.labels[index])
+    def __getstate__(self):
+        # Never pickle the memory map into worker processes
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+class ResumableSampler(torch.utils.data.Sampler):
+    # Shuffles with a seed derived from the epoch, so the order of an interrupted epoch can be reproduced, and can start part-way through an epoch
+    def __init__(self, dataset, seed=0):
+        self.seed = seed
+        self.start_index = 0
+        if distributed: # Every process reads a different shard
+            self.sampler = DistributedSampler(dataset, shuffle=True, seed=seed)
+        else:
+            self.generator = torch.Generator()
+            self.sampler = torch.utils.data.RandomSampler(dataset, generator=self.generator)
+    def set_epoch(self, epoch, start_index=0):
+        if distributed:
+            self.sampler.set_epoch(epoch)
+        else:
+            self.generator.manual_seed(self.seed + epoch)
+        self.start_index = start_index
+    def __iter__(self):
+        return itertools.islice(iter(self.sampler), self.start_index, None)
+    def __len__(self):
+        return len(self.sampler) - self.start_index
+
+def make_loader(dataset, shuffle, workers=None):
+    workers = num_workers if workers is None else workers
+    sampler = None
+    if shuffle:
+        sampler = ResumableSampler(dataset)
+    elif distributed: # Disjoint shards without the padding DistributedSampler adds, so every test sample is counted exactly once
+        dataset = torch.utils.data.Subset(dataset, range(rank, len(dataset), world_size))
+    return torch.utils.data.DataLoader(dataset, batch_size=32, shuffle=shuffle and sampler is None, sampler=sampler, num_workers=workers, pin_memory=device.type == 'cuda',
+                                       persistent_workers=workers > 0, prefetch_factor=prefetch_factor if workers > 0 else None)
+
+def benchmark_data_pipeline(loader, num_batches=100):
+    iterator = iter(loader)
+    next(iterator) # Worker startup is not counted
+    num_samples = 0
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        try:
+            images, _ = next(iterator)
+        except StopIteration:
+            break
+        num_samples += len(images)
+    return num_samples / (time.perf_counter() - start)
+
+def dataset_transforms():
+    # Returns the per-sample transform, the batched train/test augmentations and the torchvision dataset class of the selected dataset
+    import torchvision.transforms as transforms
+    import torchvision.datasets as datasets
+    if dataset == 'CIFAR10':
+        transform = transforms.Compose([
+            transforms.Resize((image_size, image_size)),
+            transforms.RandomResizedCrop(image_size, scale=(0.8, 1.0)),
+            transforms.RandomHorizontalFlip(),
+            transforms.RandomRotation(10),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        ])
+        # Same augmentations, applied on the device to uint8 batches from the dataset cache
+        train_augmentation = BatchAugmentation(image_size, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), scale=(0.8, 1.0), degrees=10, seed=None if augmentation_seed is None else augmentation_seed + rank)
+        test_augmentation = BatchAugmentation(image_size, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), train=False)
+        return transform, train_augmentation, test_augmentation, datasets.CIFAR10
     transform = transforms.Compose([
-        transforms.Resize((224, 224)),
+        transforms.Resize((image_size, image_size)),
         transforms.ToTensor(),
         transforms.Normalize((0.5,), (0.5,))
     ])
-    train_dataset = datasets.MNIST('data', train=True, download=True, transform=transform)
-    test_dataset = datasets.MNIST('data', train=False, download=True, transform=transform)
-train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=32, num_workers=0, shuffle=True, pin_memory=True)
-test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=32, num_workers=0, shuffle=False, pin_memory=True)
-
-# Visualize Cifar
-if dataset == "CIFAR10":
-    classes = ["Airplane", "Automobile", "Bird", "Cat", "Deer", "Dog", "Frog", "Horse", "Ship", "Truck"]
-elif dataset == "MNIST":
-    classes = ["0", "1", "2", "3", "4", "5", "6", "7", "8", "9"]
-batch_idx, (images, targets) = next(enumerate(train_loader))
-fig, ax = plt.subplots(3,3,figsize = (9,9))
-for i in range(3):
-    for j in range(3):
-        image = images[i*3+j].permute(1,2,0)
-        image = image/2 + 0.5
-        ax[i,j].imshow(image)
-        ax[i,j].set_axis_off()
-        ax[i,j].set_title(f'{classes[targets[i*3+j]]}')
-plt.savefig("sample_images.png")
-plt.close(fig)
+    train_augmentation = BatchAugmentation(image_size, (0.5,), (0.5,), geometric=False, seed=None if augmentation_seed is None else augmentation_seed + rank)
+    test_augmentation = BatchAugmentation(image_size, (0.5,), (0.5,), train=False)
+    return transform, train_augmentation, test_augmentation, datasets.MNIST
+
+def load_data(train=True):
+    # Downloads the dataset and builds the cache if needed. Returns (train_loader, test_loader, train_augmentation, test_augmentation); train_loader is None unless train is set.
+    transform, train_augmentation, test_augmentation, dataset_class = dataset_transforms()
+    splits = (True, False) if train else (False,)
+    # The first process of every node downloads and caches the dataset on that node's disk while the others wait
+    if distributed and local_rank != 0:
+        dist.barrier()
+    if dataset_cache_dir != "":
+        os.makedirs(dataset_cache_dir, exist_ok=True)
+        split_datasets = [CachedImageDataset(build_dataset_cache(dataset_class('data', train=split, download=True), os.path.join(dataset_cache_dir, f"{dataset}_{'train' if split else 'test'}")))
+                          for split in splits]
+    else:
+        split_datasets = [dataset_class('data', train=split, download=True, transform=transform) for split in splits]
+        train_augmentation = test_augmentation = None # Already augmented and normalized per sample by transform
+    if distributed and local_rank == 0:
+        dist.barrier()
+    train_loader = make_loader(split_datasets[0], shuffle=True) if train else None
+    test_loader = make_loader(split_datasets[-1], shuffle=False)
+    return train_loader, test_loader, train_augmentation, test_augmentation
+
+def benchmark_data_loading():
+    # Before: decode and resize every sample in the main process. After: the loaders configured above.
+    transform, _, _, dataset_class = dataset_transforms()
+    train_loader = load_data()[0]
+    baseline_loader = make_loader(dataset_class('data', train=True, download=True, transform=transform), shuffle=True, workers=0)
+    baseline_throughput = benchmark_data_pipeline(baseline_loader)
+    throughput = benchmark_data_pipeline(train_loader)
+    print(f"Data pipeline on {dataset}: {baseline_throughput:.1f} samples/s (per-sample decode and resize, no workers) -> "
+          f"{throughput:.1f} samples/s ({'memory-mapped cache' if dataset_cache_dir != '' else 'no cache'}, {num_workers} workers), {throughput / baseline_throughput:.1f}x")
+
+def visualize_samples(loader, class_names):
+    # Visualize Cifar
+    import matplotlib.pyplot as plt
+    images, targets = next(iter(loader))
+    fig, ax = plt.subplots(3,3,figsize = (9,9))
+    for i in range(3):
+        for j in range(3):
+            image = images[i*3+j].permute(1,2,0)
+            image = image/255 if image.dtype == torch.uint8 else image/2 + 0.5
+            ax[i,j].imshow(image)
+            ax[i,j].set_axis_off()
+            ax[i,j].set_title(f'{class_names[targets[i*3+j]]}')
+    plt.savefig("sample_images.png")
+    plt.close(fig)
 
 """# Step 10: Define the ViT Model"""
 
 # DEFINE THE VIT MODEL
-num_patches = (224 // 16) ** 2
 num_classes = 10
 num_heads = 8
 num_layers = 8
 mlp_dim = 2048
-VIT_model = VisionTransformer(d_model, num_classes, num_heads, num_layers, mlp_dim)
+def build_model(activation_checkpointing=False):
+    return VisionTransformer(d_model, num_classes, num_heads, num_layers, mlp_dim, image_size, patch_size, in_channels, activation_checkpointing=activation_checkpointing,
+                             token_reduction=token_reduction, token_reduction_method=token_reduction_method, exit_layers=exit_layers)
 
 """# Step 11: Train the ViT model
 The output below shows the results after 5 epochs (which is not sufficient enough for a moderately sized ViT). However, you should expect around 70% test accuracy after just 5 epochs. To achieve greater accuracy, increase the number of epochs.
@@ -347,23 +1732,74 @@ The output below shows the results after 5 epochs (which is not sufficient enoug
 
 """
 
-if mode == 'train':
-    num_epochs = 5
+def run_train(resume=False, num_epochs=5):
+    if is_main_process:
+        visualize_positional_encoding(get_positional_encoding(d_model, (image_size // patch_size) ** 2 + 1).numpy())
+        visualize_augmentation()
+    train_loader, test_loader, train_augmentation, test_augmentation = load_data()
+    if is_main_process:
+        visualize_samples(train_loader, CLASS_NAMES[dataset])
+    # On the device before the optimizer exists, so state loaded on resume lands next to the parameters
+    VIT_model = model_to_device(build_model(activation_checkpointing))
+    if finetune_from != "" and not resume:
+        load_weights(VIT_model, finetune_from, new_exit_heads=True)
+        print(f"Fine-tuning from '{finetune_from}'")
+    train_model = VIT_model
+    if distributed:
+        # The positional encoding is the only buffer and is identical everywhere, so buffers are not broadcast every step
+        train_model = DistributedDataParallel(VIT_model, device_ids=[device.index] if device.type == 'cuda' else None, broadcast_buffers=False)
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.AdamW(VIT_model.parameters(), lr=1e-4, weight_decay=1e-4)
     scheduler = CosineAnnealingLR(optimizer, T_max=num_epochs, eta_min=1e-6)
+    scaler = torch.amp.GradScaler(init_scale=2.**16, device=device.type, enabled=device.type == 'cuda')
     learning_rates = []
-    best_val_loss = float('inf')
-    for epoch in range(num_epochs):
-        learning_rates.append(optimizer.param_groups[0]["lr"]) # Record learning rate schedule
-        train(VIT_model, criterion, optimizer, train_loader, epoch) # Train
-        test(VIT_model, criterion, test_loader, epoch) # Test
+    checkpoint_manager = CheckpointManager(checkpoint_dir, VIT_model, optimizer, scaler, scheduler, train_augmentation,
+                                           histories={'train_losses': train_losses, 'train_accuracies': train_accuracies, 'train_throughputs': train_throughputs,
+                                                      'test_losses': test_losses, 'test_accuracies': test_accuracies, 'learning_rates': learning_rates},
+                                           keep_last=keep_last_checkpoints, keep_best=keep_best_checkpoints, best_weights_path=torch_save_dir)
+    start_epoch, start_batch, epoch_totals = 0, 0, None
+    resume_state = checkpoint_manager.load_latest() if resume else None
+    if resume and distributed:
+        # Only rank 0 writes checkpoints; every process must have read the same one, or they would disagree on the loop length and hang in all_reduce
+        positions = [None] * world_size
+        dist.all_gather_object(positions, None if resume_state is None else (resume_state['epoch'], resume_state['batch']))
+        if len(set(positions)) > 1:
+            raise RuntimeError(f"Processes found different checkpoints to resume from in '{checkpoint_dir}' (epoch, batch per rank: {positions}). "
+                               "With several hosts, checkpoint_dir must be on a filesystem shared by all of them.")
+    if resume_state is not None:
+        start_epoch, start_batch, epoch_totals = resume_state['epoch'], resume_state['batch'], resume_state['epoch_totals']
+    elif resume:
+        print(f"No checkpoint found in '{checkpoint_dir}', training from scratch.")
+    else:
+        checkpoint_manager.clear()
+    for epoch in range(start_epoch, num_epochs):
+        if start_batch == 0: # Already recorded when resuming mid-epoch
+            learning_rates.append(optimizer.param_groups[0]["lr"]) # Record learning rate schedule
+        train(train_model, criterion, optimizer, train_loader, epoch, augmentation=train_augmentation, accumulation_steps=grad_accumulation_steps, scaler=scaler,
+              checkpoint_manager=checkpoint_manager, start_batch=start_batch, epoch_totals=epoch_totals) # Train
+        start_batch, epoch_totals = 0, None
+        test(VIT_model, criterion, test_loader, epoch, augmentation=test_augmentation) # Test
         current_val_loss = test_losses[-1] # Determine the best loss to save it as a model checkpoint
-        if current_val_loss < best_val_loss:
-            best_val_loss = current_val_loss
-            torch.save(VIT_model.state_dict(), torch_save_dir)
-            print(f"** Optimal Checkpoint Saved with Validation Loss: {best_val_loss:.3f} **")
+        is_best = current_val_loss < checkpoint_manager.best_val_loss
+        if is_best:
+            checkpoint_manager.best_val_loss = current_val_loss
         scheduler.step()
+        # Written in the background; the best weights are also exported to torch_save_dir
+        checkpoint_manager.save(epoch + 1, val_loss=current_val_loss, export_best=is_best)
+        if is_best:
+            print(f"** Optimal Checkpoint Saved with Validation Loss: {current_val_loss:.3f} **")
+    checkpoint_manager.wait()
+    # Append a run summary so that runs at different resolutions (224px baseline vs. native) can be compared
+    run_summary = {'dataset': dataset, 'image_size': image_size, 'patch_size': patch_size, 'tokens': VIT_model.num_patches + 1, 'epochs': num_epochs,
+                   'best_test_accuracy': max(test_accuracies), 'final_test_accuracy': test_accuracies[-1], 'train_samples_per_sec': float(np.mean(train_throughputs))}
+    if is_main_process:
+        with open("training_runs.jsonl", "a") as f:
+            f.write(json.dumps(run_summary) + "\n")
+    print(f"Run summary at {image_size}px with {patch_size}px patches: best test accuracy {run_summary['best_test_accuracy']:.3f}% at {run_summary['train_samples_per_sec']:.1f} train samples/s (appended to 'training_runs.jsonl')")
+    if is_main_process:
+        plot_learning_curves(learning_rates)
+    if distributed:
+        dist.destroy_process_group()
 
 """# Step 12: Plot Learning Curves
 Includes:
@@ -372,7 +1808,8 @@ Includes:
 - Learning Rate Schedule Curve
 """
 
-if mode == 'train':
+def plot_learning_curves(learning_rates):
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(15, 10))
     # Plot Train and Test Loss
     plt.subplot(3, 1, 1)
@@ -404,56 +1841,896 @@ if mode == 'train':
 
 """# Real-World Testing
 Finally, we can test our model by inputting images found online and see if it can successfully classify the image.
+
+Images are streamed from the folder: a thread pool decodes them (JPEGs are decoded directly at reduced scale) into a bounded prefetch queue, batches go through the model, and predictions are written to `predictions_file` as they arrive, so memory stays flat no matter how many images the folder holds.
 """
 
-def preprocess_image(image_path):
+def iter_image_files(folder):
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                yield entry.path
+
+def decode_image(image_path, image_size, channels):
+    # Returns a uint8 [channels, image_size, image_size] tensor, or None if the image can't be read
     try:
-        img = Image.open(image_path)
-        return img.resize((224, 224))
+        with Image.open(image_path) as img:
+            image_mode = 'L' if channels == 1 else 'RGB'
+            img.draft(image_mode, (image_size, image_size)) # Let the JPEG decoder downscale while decoding
+            img = img.convert(image_mode).resize((image_size, image_size), Image.BILINEAR)
+            return torch.from_numpy(np.asarray(img, dtype=np.uint8).reshape(image_size, image_size, channels).transpose(2, 0, 1).copy())
     except Exception as e:
-        print(f"Error loading image: {e}")
+        print(f"Error loading image {image_path}: {e}")
         return None
 
-def load_images_from_folder(folder):
-    images = []
-    for filename in os.listdir(folder):
-        img_path = os.path.join(folder, filename)
-        if img_path.endswith(('.png', '.jpg', '.jpeg')):
-            image = preprocess_image(img_path)
-            if image is not None:
-                images.append((image, filename))
-    return images
-
-def predict(folder, model, class_names):
-    model.to(device)
+def stream_image_batches(folder, image_size, channels, batch_size, num_threads, max_prefetch):
+    def decoded_images():
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            pending = deque()
+            for image_path in iter_image_files(folder):
+                pending.append((image_path, pool.submit(decode_image, image_path, image_size, channels)))
+                if len(pending) >= max_prefetch: # Bounded prefetch: wait for the oldest image before listing more
+                    image_path, future = pending.popleft()
+                    yield image_path, future.result()
+            while pending:
+                image_path, future = pending.popleft()
+                yield image_path, future.result()
+    batch_paths, batch_images = [], []
+    for image_path, image in decoded_images():
+        if image is None:
+            continue
+        batch_paths.append(image_path)
+        batch_images.append(image)
+        if len(batch_images) == batch_size:
+            yield batch_paths, torch.stack(batch_images)
+            batch_paths, batch_images = [], []
+    if batch_images:
+        yield batch_paths, torch.stack(batch_images)
+
+def early_exit_logits(model, images, budget_ms=None):
+    # With early-exit heads, easy images leave as soon as a head is confident (or the latency budget is spent)
+    if len(model.exit_heads) == 0:
+        return model(images)
+    if budget_ms is None and exit_budget_ms > 0:
+        budget_ms = exit_budget_ms
+    return model.forward_early_exit(images, exit_threshold, budget_ms)[0]
+
+def predict(folder, model, class_names, batch_size=None, output_file=None, plot=None, num_threads=None):
+    # Unset arguments fall back to the prediction settings of Step 2
+    batch_size = predict_batch_size if batch_size is None else batch_size
+    output_file = predictions_file if output_file is None else output_file
+    plot = plot_predictions if plot is None else plot
+    num_threads = predict_num_threads if num_threads is None else num_threads
+    model_to_device(model)
     model.eval()
-    images = load_images_from_folder(folder)
-    num_images = len(images)
-    cols = 4
-    rows = (num_images + cols - 1) // cols
-    plt.figure(figsize=(10, (rows) * 5))
-    for i, (image, filename) in enumerate(images):
-        if dataset == 'MNIST':
-            image = image.convert('L')
-        image_tensor = transform(image).unsqueeze(0).to(device)
-        with torch.no_grad():
-            output = model(image_tensor)
-            _, predicted_class = torch.max(output.data, 1)
-        plt.subplot(rows, cols, i + 1)
-        plt.imshow(image, cmap='gray' if dataset == 'MNIST' else None)
-        plt.title(f"{filename}\nPredicted: {class_names[predicted_class.item()]}")
-        plt.axis('off')
-    plt.tight_layout()
-    plt.savefig('predicted_images.png', bbox_inches='tight', dpi=300)
-    print("Predictions saved as 'predicted_images.png'")
-    plt.show()
+    channels = model.conv_projection.in_channels
+    normalization = BatchAugmentation(model.image_size, (0.5,) * channels, (0.5,) * channels, train=False)
+    jsonl = output_file.endswith('.jsonl')
+    batch_latencies, plotted_images = [], []
+    num_images = 0
+    start = time.perf_counter()
+    with open(output_file, 'w', newline='') as f:
+        writer = None if jsonl else csv.writer(f)
+        if writer is not None:
+            writer.writerow(['filename', 'predicted_class', 'class_name', 'confidence'])
+        for image_paths, images in stream_image_batches(folder, model.image_size, channels, batch_size, num_threads, max_prefetch=2 * batch_size):
+            batch_start = time.perf_counter()
+            with torch.no_grad(), autocast():
+                probabilities = F.softmax(early_exit_logits(model, normalization(to_device(images))).float(), dim=1)
+            confidences, predicted_classes = probabilities.max(1)
+            confidences, predicted_classes = confidences.tolist(), predicted_classes.tolist() # Copies to the host, so the batch has finished
+            batch_latencies.append(time.perf_counter() - batch_start)
+            for i, (image_path, predicted_class, confidence) in enumerate(zip(image_paths, predicted_classes, confidences)):
+                filename = os.path.basename(image_path)
+                if jsonl:
+                    f.write(json.dumps({'filename': filename, 'predicted_class': predicted_class, 'class_name': class_names[predicted_class], 'confidence': confidence}) + "\n")
+                else:
+                    writer.writerow([filename, predicted_class, class_names[predicted_class], f"{confidence:.4f}"])
+                if plot and len(plotted_images) < max_plot_images:
+                    plotted_images.append((filename, images[i].permute(1, 2, 0).squeeze(-1).numpy(), class_names[predicted_class]))
+            f.flush()
+            num_images += len(image_paths)
+    elapsed = time.perf_counter() - start
+    if num_images == 0:
+        print(f"No images found in '{folder}'")
+        return None
+    stats = {'num_images': num_images, 'images_per_sec': num_images / elapsed, 'batch_latency_p50_ms': 1000 * float(np.percentile(batch_latencies, 50)),
+             'batch_latency_p99_ms': 1000 * float(np.percentile(batch_latencies, 99))}
+    print(f"Classified {num_images} images in {elapsed:.1f}s ({stats['images_per_sec']:.1f} images/s, batch latency p50 {stats['batch_latency_p50_ms']:.1f} ms / p99 {stats['batch_latency_p99_ms']:.1f} ms). Predictions saved as '{output_file}'")
+    if plot:
+        import matplotlib.pyplot as plt
+        cols = 4
+        rows = (len(plotted_images) + cols - 1) // cols
+        plt.figure(figsize=(10, (rows) * 5))
+        for i, (filename, image, class_name) in enumerate(plotted_images):
+            plt.subplot(rows, cols, i + 1)
+            plt.imshow(image, cmap='gray' if channels == 1 else None)
+            plt.title(f"{filename}\nPredicted: {class_name}")
+            plt.axis('off')
+        plt.tight_layout()
+        plt.savefig('predicted_images.png', bbox_inches='tight', dpi=300)
+        print("Predictions saved as 'predicted_images.png'")
+        plt.show()
+        plt.close()
+    return stats
+
+def load_model(path=None):
+    # The best weights saved by training, memory-mapped from torch_save_dir
+    return load_weights(build_model(), torch_save_dir if path is None else path)
+
+def run_predict(folder):
+    if folder == "":
+        print(f"No image folder given. Pass one to the predict command or set {dataset.replace('10', '')}_testing_dir.")
+        return None
+    return predict(folder, load_model(), CLASS_NAMES[dataset], batch_size=predict_batch_size, output_file=predictions_file, plot=plot_predictions, num_threads=predict_num_threads)
+
+def timed_evaluation(run, test_loader, augmentation=None, max_batches=None):
+    # Test accuracy, mean encoder blocks run and throughput of run(images) -> (logits, blocks run per sample or None). Only the forward passes are timed, after a warmup on the first batch.
+    correct, layers = torch.zeros((), device=device), torch.zeros((), device=device)
+    total, elapsed = 0, 0.0
+    with torch.no_grad(), autocast():
+        for batch_idx, (images, targets) in enumerate(itertools.islice(test_loader, max_batches)):
+            images, targets = to_device(images), targets.to(device, non_blocking=True)
+            if augmentation is not None: # uint8 batches only need normalizing
+                images = augmentation(images)
+            if batch_idx == 0:
+                run(images) # Warmup
+            synchronize()
+            start = time.perf_counter()
+            outputs, layers_run = run(images)
+            synchronize()
+            elapsed += time.perf_counter() - start
+            correct += (outputs.argmax(1) == targets).sum()
+            if layers_run is not None:
+                layers += layers_run.sum()
+            total += len(targets)
+    return {'accuracy': 100 * correct.item() / total, 'mean_layers': layers.item() / total, 'images_per_sec': total / elapsed}
+
+def token_reduction_tradeoff(model, test_loader, augmentation=None, reductions=(2, 4, 8, 12, 16, 24), methods=TOKEN_REDUCTION_METHODS, max_batches=None):
+    # Test accuracy vs. model throughput without reduction and with each constant per-block reduction r, for every method
+    model_to_device(model).eval()
+    configurations = [(token_reduction_method, 0)] + [(method, r) for method in methods for r in reductions]
+    results = []
+    for method, r in configurations:
+        model.set_token_reduction(r, method)
+        evaluation = timed_evaluation(lambda images: (model(images), None), test_loader, augmentation, max_batches)
+        tokens = remaining_tokens(model.num_patches + 1, model.token_reduction, method)
+        results.append({'method': method if r > 0 else 'none', 'r': r, 'final_tokens': tokens[-1], 'mean_tokens': float(np.mean(tokens)),
+                        'accuracy': evaluation['accuracy'], 'images_per_sec': evaluation['images_per_sec']})
+    model.set_token_reduction(token_reduction, token_reduction_method)
+    return results
+
+def print_token_reduction_report(results):
+    print(f"Token reduction on the {dataset} test set at {image_size}px ({results[0]['final_tokens']} tokens) on {device.type.upper()}")
+    print(f"{'Method':>6} | {'r':>3} | {'Last block tokens':>17} | {'Mean tokens':>11} | {'Accuracy':>8} | {'Img/s':>8} | {'Speedup':>7}")
+    for r in results:
+        print(f"{r['method']:>6} | {r['r']:>3} | {r['final_tokens']:>17} | {r['mean_tokens']:>11.1f} | {r['accuracy']:>7.2f}% | {r['images_per_sec']:>8.1f} | {r['images_per_sec'] / results[0]['images_per_sec']:>6.2f}x")
+
+def plot_token_reduction_tradeoff(results):
+    import matplotlib.pyplot as plt
+    plt.figure(figsize=(8, 6))
+    for method in TOKEN_REDUCTION_METHODS:
+        points = [results[0]] + [r for r in results if r['method'] == method]
+        plt.plot([r['images_per_sec'] for r in points], [r['accuracy'] for r in points], marker='o', label=method)
+        for r in points:
+            plt.annotate(f"r={r['r']}", (r['images_per_sec'], r['accuracy']), textcoords='offset points', xytext=(4, 4), fontsize=8)
+    plt.xlabel("Throughput (images/s)")
+    plt.ylabel("Test Accuracy (%)")
+    plt.title(f"Token Reduction Speed/Accuracy Tradeoff ({dataset}, {image_size}px)")
+    plt.legend()
+    plt.savefig("token_reduction_tradeoff.png")
     plt.close()
 
-optimal_model = VisionTransformer(d_model, num_classes, num_heads, num_layers, mlp_dim)
-optimal_model.load_state_dict(torch.load(torch_save_dir, weights_only=True))
-if dataset == 'CIFAR10' and CIFAR_testing_dir != "":
-    predict(CIFAR_testing_dir, optimal_model, classes)
-if dataset == 'MNIST' and MNIST_testing_dir != "":
-    predict(MNIST_testing_dir, optimal_model, classes)
+def early_exit_tradeoff(model, test_loader, augmentation=None, thresholds=(0.5, 0.7, 0.8, 0.9, 0.95, 0.99), budget_ms=None, max_batches=None):
+    # Test accuracy, mean encoder blocks run and throughput of the full model and of the early-exit policy at each confidence threshold (and under a latency budget)
+    model_to_device(model).eval()
+    configurations = [('full', None)] + [('threshold', threshold) for threshold in thresholds] + ([('budget', budget_ms)] if budget_ms else [])
+    results = []
+    for policy, value in configurations:
+        def run(images, policy=policy, value=value):
+            if policy == 'full':
+                return model(images), torch.full((len(images),), len(model.encoder_blocks), device=device)
+            if policy == 'threshold':
+                return model.forward_early_exit(images, value)
+            return model.forward_early_exit(images, 1.01, value) # Only the budget decides
+        results.append(dict(timed_evaluation(run, test_loader, augmentation, max_batches), policy=policy, value=value))
+    return results
+
+def print_early_exit_report(results, tolerance=0.5):
+    full = results[0]
+    print(f"Early exit on the {dataset} test set with heads after blocks {list(exit_layers)} on {device.type.upper()} (full depth: {full['mean_layers']:.0f} blocks)")
+    print(f"{'Policy':>9} | {'Value':>6} | {'Accuracy':>8} | {'Mean blocks':>11} | {'Img/s':>8} | {'Speedup':>7}")
+    for r in results:
+        print(f"{r['policy']:>9} | {'' if r['value'] is None else r['value']:>6} | {r['accuracy']:>7.2f}% | {r['mean_layers']:>11.2f} | {r['images_per_sec']:>8.1f} | {r['images_per_sec'] / full['images_per_sec']:>6.2f}x")
+    # Fastest confidence threshold that stays within `tolerance` accuracy points of the full model
+    candidates = [r for r in results if r['policy'] == 'threshold' and r['accuracy'] >= full['accuracy'] - tolerance]
+    if candidates:
+        best = max(candidates, key=lambda r: r['images_per_sec'])
+        print(f"At {best['accuracy']:.2f}% accuracy (within {tolerance} points of full depth), threshold {best['value']} runs {best['mean_layers']:.2f} blocks on average: "
+              f"{best['images_per_sec'] / full['images_per_sec']:.2f}x the throughput of the full model.")
+    else:
+        print(f"No threshold stays within {tolerance} accuracy points of the full model.")
+
+def run_eval(tradeoff=False, max_batches=None, early_exit=False):
+    # Accuracy of the saved model on the test split, optionally with the token reduction and early-exit speed/accuracy tradeoffs
+    _, test_loader, _, test_augmentation = load_data(train=False)
+    model = load_model()
+    test(model, nn.CrossEntropyLoss(), test_loader, augmentation=test_augmentation)
+    if early_exit:
+        if len(model.exit_heads) == 0:
+            print("The model has no early-exit heads. Set exit_layers (--exit-layers) and train or fine-tune them first.")
+        else:
+            results = early_exit_tradeoff(model, test_loader, test_augmentation, budget_ms=exit_budget_ms or None, max_batches=max_batches)
+            if is_main_process:
+                print_early_exit_report(results)
+                with open("early_exit_tradeoff.json", "w") as f:
+                    json.dump(results, f, indent=2)
+    if tradeoff:
+        results = token_reduction_tradeoff(model, test_loader, test_augmentation, max_batches=max_batches)
+        if is_main_process:
+            print_token_reduction_report(results)
+            with open("token_reduction_tradeoff.json", "w") as f:
+                json.dump(results, f, indent=2)
+            plot_token_reduction_tradeoff(results)
+            print("Tradeoff curve saved as 'token_reduction_tradeoff.png'")
+    if distributed:
+        dist.destroy_process_group()
+
+"""# Serving the Model
+`python ViT.py serve` loads the checkpoint once and serves it over HTTP on localhost:
+- `POST /predict` with the raw bytes of a .png/.jpg image returns the class probabilities.
+- `GET /health` returns `{"status": "ok"}`.
+- `GET /metrics` returns the queue depth, the batch-size histogram and latency percentiles.
+
+Concurrent requests are coalesced into batches of up to `serve_max_batch_size`, waiting at most `serve_max_wait_ms` for a batch to fill. Decoding runs on a thread pool and the model runs on its own thread, so the event loop keeps accepting requests meanwhile. `loadgen.py` measures throughput vs. latency under concurrency.
+"""
+
+class InferenceServer:
+    def __init__(self, model, class_names, max_batch_size=None, max_wait_ms=None, max_body_bytes=20 * 2**20):
+        self.model = model_to_device(model).eval()
+        self.class_names = class_names
+        self.channels = model.conv_projection.in_channels
+        self.normalization = BatchAugmentation(model.image_size, (0.5,) * self.channels, (0.5,) * self.channels, train=False)
+        self.max_batch_size = serve_max_batch_size if max_batch_size is None else max_batch_size
+        self.max_wait = (serve_max_wait_ms if max_wait_ms is None else max_wait_ms) / 1000
+        self.max_body_bytes = max_body_bytes
+        self.decode_pool = ThreadPoolExecutor(max_workers=predict_num_threads)
+        self.model_pool = ThreadPoolExecutor(max_workers=1)
+        self.queue = None # Created inside the running event loop
+        self.batch_size_histogram = Counter()
+        self.latencies = deque(maxlen=10000) # Latency of the most recent requests, in seconds
+        self.num_requests = 0
+        self.start_time = time.time()
+
+    def run_batch(self, images, arrival_times):
+        # Every request's latency budget counts from its arrival, including the time spent in the queue
+        budgets = [exit_budget_ms - 1000 * (time.perf_counter() - arrival_time) for arrival_time in arrival_times] if exit_budget_ms > 0 else None
+        with torch.no_grad(), autocast():
+            logits = early_exit_logits(self.model, self.normalization(to_device(images)), budgets)
+        return F.softmax(logits.float(), dim=1).cpu().tolist()
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                probabilities = await loop.run_in_executor(self.model_pool, self.run_batch, torch.stack([image for image, _, _ in requests]), [start for _, _, start in requests])
+            except Exception as e:
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batch_size_histogram[len(requests)] += 1
+            for (_, future, _), request_probabilities in zip(requests, probabilities):
+                if not future.done(): # The client may have disconnected
+                    future.set_result(request_probabilities)
+
+    def metrics(self):
+        latencies = 1000 * np.array(self.latencies) if self.latencies else np.zeros(1)
+        num_batches = sum(self.batch_size_histogram.values())
+        return {'queue_depth': self.queue.qsize(), 'requests': self.num_requests, 'batches': num_batches,
+                'mean_batch_size': sum(size * count for size, count in self.batch_size_histogram.items()) / max(num_batches, 1),
+                'batch_size_histogram': {str(size): self.batch_size_histogram[size] for size in sorted(self.batch_size_histogram)},
+                'latency_ms': {'p50': float(np.percentile(latencies, 50)), 'p90': float(np.percentile(latencies, 90)), 'p99': float(np.percentile(latencies, 99))},
+                'uptime_s': time.time() - self.start_time}
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return '200 OK', {'status': 'ok'}
+        if method == 'GET' and path == '/metrics':
+            return '200 OK', self.metrics()
+        if method != 'POST' or path != '/predict':
+            return '404 Not Found', {'error': f"Unknown endpoint {method} {path}"}
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(self.decode_pool, decode_image, io.BytesIO(body), self.model.image_size, self.channels)
+        if image is None:
+            return '400 Bad Request', {'error': "Could not decode the image"}
+        future = loop.create_future()
+        await self.queue.put((image, future, start))
+        probabilities = await future
+        self.latencies.append(time.perf_counter() - start)
+        self.num_requests += 1
+        predicted_class = int(np.argmax(probabilities))
+        return '200 OK', {'predicted_class': predicted_class, 'class_name': self.class_names[predicted_class],
+                          'probabilities': dict(zip(self.class_names, probabilities))}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True: # HTTP/1.1 keep-alive
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get('content-length', 0))
+                if content_length > self.max_body_bytes:
+                    status, payload = '413 Payload Too Large', {'error': f"Images are limited to {self.max_body_bytes} bytes"}
+                    headers['connection'] = 'close'
+                else:
+                    body = await reader.readexactly(content_length)
+                    try:
+                        status, payload = await self.route(method, path.split('?')[0], body)
+                    except Exception as e: # E.g. a failed batch: answer this request and keep serving the connection
+                        print(f"Request {method} {path} failed: {type(e).__name__}: {e}")
+                        status, payload = '500 Internal Server Error', {'error': f"{type(e).__name__}: {e}"}
+                data = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=None, port=None):
+        host, port = serve_host if host is None else host, serve_port if port is None else port
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} (max batch size {self.max_batch_size}, max wait {1000 * self.max_wait:.1f} ms). Press Ctrl+C to stop.")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+def run_serve():
+    server = InferenceServer(load_model(), CLASS_NAMES[dataset], max_batch_size=serve_max_batch_size, max_wait_ms=serve_max_wait_ms)
+    try:
+        asyncio.run(server.serve(serve_host, serve_port))
+    except KeyboardInterrupt:
+        print("Server stopped.")
+
+"""# Exporting for CPU Inference
+`python ViT.py export` turns the saved checkpoint into CPU inference variants and compares each with the eager fp32 model:
+- 'int8-dynamic': int8 weights for every Linear layer (the fused QKV and output projections and the MLPs); activations are quantized on the fly.
+- 'int8-static': int8 weights and activations for the Linear layers and the patch convolution, calibrated on `export_calibration_batches` training batches (FX graph mode). LayerNorm, attention and GELU stay in float.
+- 'torchscript': traced, frozen and optimized for inference.
+- 'compile': `torch.compile` (inductor), with its compiled kernels cached in `export_dir`.
+- 'onnx': exported to ONNX and run with onnxruntime, if it is installed.
+
+The int8 and TorchScript variants are saved as TorchScript files and the ONNX variant as an .onnx file in `export_dir`, named after a fingerprint of the checkpoint, so later runs load them instead of exporting again. The report lists test accuracy (and its change from fp32), batch-1 latency, batched throughput and size on disk of each variant.
+"""
+
+EXPORT_VARIANTS = ('fp32', 'int8-dynamic', 'int8-static', 'torchscript', 'compile', 'onnx')
+
+def checkpoint_fingerprint(path):
+    # Content hash of the weights plus everything else that changes the exported graph
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    digest.update(f"{image_size}:{patch_size}:{in_channels}:{torch.__version__}".encode())
+    return digest.hexdigest()[:16]
+
+def quantize_static(model, calibration_data):
+    from torch.ao.quantization import QConfigMapping, get_default_qconfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    if any(model.token_reduction):
+        raise ValueError("Static quantization traces the model symbolically, which token reduction does not support. Export with --token-reduction 0.")
+    qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    # Only the Linear layers and the patch convolution are quantized; everything else stays in float between dequantize/quantize pairs
+    qconfig_mapping = QConfigMapping().set_object_type(nn.Linear, qconfig).set_object_type(nn.Conv2d, qconfig)
+    prepared = prepare_fx(copy.deepcopy(model), qconfig_mapping, example_inputs=(calibration_data[0],))
+    with torch.no_grad():
+        for images in calibration_data:
+            prepared(images)
+    return convert_fx(prepared)
+
+def build_variant(variant, model, example, calibration_data, cache_prefix):
+    # Returns (callable mapping a normalized float batch to logits, size on disk in bytes), or None if the variant is unavailable
+    if variant == 'fp32':
+        return model, os.path.getsize(torch_save_dir)
+    if variant == 'compile':
+        return torch.compile(model), os.path.getsize(torch_save_dir)
+    if variant == 'onnx':
+        try:
+            import onnxruntime
+        except ImportError:
+            print("onnxruntime is not installed, skipping the 'onnx' variant.")
+            return None
+        path = cache_prefix + '.onnx'
+        if not os.path.exists(path):
+            torch.onnx.export(model, (example,), path + '.tmp', input_names=['images'], output_names=['logits'],
+                              dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17)
+            os.replace(path + '.tmp', path)
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        return (lambda images: torch.from_numpy(session.run(None, {'images': images.numpy()})[0])), os.path.getsize(path)
+    path = f"{cache_prefix}.{variant}.pt"
+    if not os.path.exists(path):
+        if variant == 'int8-dynamic':
+            source = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        elif variant == 'int8-static':
+            source = quantize_static(model, calibration_data)
+        else:
+            source = model
+        with torch.no_grad():
+            traced = torch.jit.freeze(torch.jit.trace(source, example).eval())
+        torch.jit.save(traced, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    exported = torch.jit.load(path)
+    if variant == 'torchscript': # Fuses and pre-packs the float ops for the CPU; not serializable, so applied after loading
+        exported = torch.jit.optimize_for_inference(exported)
+    return exported, os.path.getsize(path)
+
+def measure_latency(run, images, num_warmup=3, num_iters=20):
+    # Median wall-clock time of one forward pass, in ms
+    times = []
+    with torch.no_grad():
+        for i in range(num_warmup + num_iters):
+            start = time.perf_counter()
+            run(images)
+            if i >= num_warmup:
+                times.append(time.perf_counter() - start)
+    return 1000 * float(np.median(times))
+
+def evaluate_variant(run, test_loader, normalize, max_batches=None):
+    correct = total = 0
+    with torch.no_grad():
+        for images, targets in itertools.islice(test_loader, max_batches):
+            correct += (run(normalize(images)).argmax(1) == targets).sum().item()
+            total += len(targets)
+    return 100 * correct / total
+
+def run_export(variants=EXPORT_VARIANTS, max_batches=None):
+    os.makedirs(export_dir, exist_ok=True)
+    # torch.compile keeps its compiled kernels here, so later runs skip most of the compilation
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(os.path.join(export_dir, 'inductor')))
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    torch.backends.quantized.engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+    model = load_model().cpu().eval() # Exported for CPU inference, in float32 without autocast
+    train_loader, test_loader, _, test_augmentation = load_data(train='int8-static' in variants)
+    def normalize(images):
+        # uint8 batches from the dataset cache are normalized here; otherwise the loader already did it
+        return (test_augmentation(images) if test_augmentation is not None else images).contiguous()
+    calibration_data = [normalize(images) for images, _ in itertools.islice(train_loader, export_calibration_batches)] if train_loader is not None else None
+    batch = normalize(next(iter(test_loader))[0])
+    example = batch[:1]
+    cache_prefix = os.path.join(export_dir, f"{dataset}_{image_size}px_{checkpoint_fingerprint(torch_save_dir)}")
+    results, skipped = [], []
+    for variant in variants:
+        start = time.perf_counter()
+        try:
+            built = build_variant(variant, model, example, calibration_data, cache_prefix)
+            if built is None:
+                skipped.append({'variant': variant, 'error': 'unavailable'})
+                continue
+            run, size = built
+            with torch.no_grad():
+                run(example) # torch.compile compiles on the first call
+            export_time = time.perf_counter() - start
+            batch_latency = measure_latency(run, batch)
+            result = {'variant': variant, 'accuracy': evaluate_variant(run, test_loader, normalize, max_batches), 'latency_ms': measure_latency(run, example),
+                      'images_per_sec': 1000 * len(batch) / batch_latency, 'size_mb': size / 2**20, 'export_s': export_time}
+        except Exception as e: # One variant failing (e.g. no C compiler for torch.compile) must not lose the others
+            print(f"Variant '{variant}' failed, skipping it: {type(e).__name__}: {e}")
+            skipped.append({'variant': variant, 'error': f"{type(e).__name__}: {e}"})
+            continue
+        results.append(result)
+        print(f"Evaluated '{variant}'")
+    baseline = next((r for r in results if r['variant'] == 'fp32'), results[0] if results else None)
+    for r in results:
+        r['accuracy_delta'] = r['accuracy'] - baseline['accuracy']
+    with open(os.path.join(export_dir, 'export_report.json'), 'w') as f:
+        json.dump({'dataset': dataset, 'image_size': image_size, 'checkpoint': torch_save_dir, 'threads': torch.get_num_threads(), 'results': results, 'skipped': skipped}, f, indent=2)
+    print_export_report(results, batch_size=len(batch))
+    if skipped:
+        print("Skipped variants: " + ", ".join(f"{s['variant']} ({s['error']})" for s in skipped))
+    return results
+
+def print_export_report(results, batch_size):
+    print(f"CPU inference variants of '{torch_save_dir}' ({torch.get_num_threads()} threads, throughput at batch size {batch_size}, export time includes the first call)")
+    print(f"{'Variant':>12} | {'Accuracy':>8} | {'Delta':>6} | {'Latency ms':>10} | {'Img/s':>7} | {'Size MB':>7} | {'Export s':>8}")
+    for r in results:
+        print(f"{r['variant']:>12} | {r['accuracy']:>7.2f}% | {r['accuracy_delta']:>+6.2f} | {r['latency_ms']:>10.2f} | {r['images_per_sec']:>7.1f} | {r['size_mb']:>7.1f} | {r['export_s']:>8.1f}")
+
+"""# Feature Store: Embeddings, Linear Probing and k-NN
+`python ViT.py extract` runs the backbone once over dataset splits or an image folder and writes the embeddings to a feature store in `feature_store_dir`: `.npy` chunks of `feature_chunk_size` rows (class token embeddings, optionally mean patch embeddings, and labels) plus a JSON manifest. Like the dataset cache, the store is written to a temporary directory that is renamed into place, and its fingerprint (checkpoint, source and settings) lets later runs reuse it. Chunks are memory-mapped when read.
+
+- `python ViT.py probe` trains a linear classifier on the stored train embeddings and evaluates it on the test embeddings. The features fit in memory, so this takes seconds instead of a pass over the images. It also reports the k-NN accuracy of the test embeddings against the train embeddings.
+- `python ViT.py knn <folder>` finds the nearest stored images of every image in a folder. `KNNIndex` keeps the L2-normalized embeddings in blocks, so a batch of queries is one matrix multiply per block followed by a running top-k, and memory stays bounded by the block size.
+"""
+
+FEATURE_STORE_VERSION = 1
+
+class FeatureStoreWriter:
+    def __init__(self, directory, embedding_dim, pool_patches=False, chunk_size=None, dtype=None):
+        chunk_size, dtype = feature_chunk_size if chunk_size is None else chunk_size, feature_dtype if dtype is None else dtype
+        self.directory, self.temporary_directory = directory, directory + '.tmp'
+        shutil.rmtree(self.temporary_directory, ignore_errors=True)
+        os.makedirs(self.temporary_directory)
+        self.embedding_dim, self.pool_patches, self.chunk_size, self.dtype = embedding_dim, pool_patches, chunk_size, np.dtype(dtype)
+        self.buffers = {'class': [], 'patch': [], 'labels': []}
+        self.buffered = 0
+        self.chunks, self.paths = [], []
+    def add(self, class_features, patch_features=None, labels=None, paths=None):
+        self.buffers['class'].append(class_features.float().cpu().numpy().astype(self.dtype))
+        if self.pool_patches:
+            self.buffers['patch'].append(patch_features.float().cpu().numpy().astype(self.dtype))
+        self.buffers['labels'].append(np.full(len(class_features), -1, dtype=np.int64) if labels is None else labels.cpu().numpy().astype(np.int64))
+        self.paths.extend(paths or [])
+        self.buffered += len(class_features)
+        while self.buffered >= self.chunk_size:
+            self.flush(self.chunk_size)
+    def flush(self, num_rows):
+        chunk = {'num_samples': num_rows}
+        for kind in ('class', 'patch', 'labels'):
+            if not self.buffers[kind]:
+                continue
+            rows = np.concatenate(self.buffers[kind])
+            chunk[kind] = f"{kind}_{len(self.chunks):05d}.npy"
+            np.save(os.path.join(self.temporary_directory, chunk[kind]), rows[:num_rows])
+            self.buffers[kind] = [rows[num_rows:]] if len(rows) > num_rows else []
+        self.chunks.append(chunk)
+        self.buffered -= num_rows
+    def close(self, metadata):
+        if self.buffered > 0:
+            self.flush(self.buffered)
+        manifest = dict(metadata, version=FEATURE_STORE_VERSION, embedding_dim=self.embedding_dim, dtype=self.dtype.name, pool_patches=self.pool_patches,
+                        num_samples=sum(chunk['num_samples'] for chunk in self.chunks), chunks=self.chunks, paths=self.paths)
+        with open(os.path.join(self.temporary_directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        # Rename into place last, so an interrupted extraction is never mistaken for a valid store
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(self.temporary_directory, self.directory)
+        return manifest
+
+class FeatureStore:
+    # Read-only view of a feature store; chunks are memory-mapped on first use
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self._chunks = {}
+    def __len__(self):
+        return self.manifest['num_samples']
+    @property
+    def paths(self):
+        return self.manifest['paths']
+    def chunk(self, index, kind='class'):
+        if (index, kind) not in self._chunks:
+            self._chunks[(index, kind)] = np.load(os.path.join(self.directory, self.manifest['chunks'][index][kind]), mmap_mode='r')
+        return self._chunks[(index, kind)]
+    def iter_chunks(self, kind='class'):
+        for index in range(len(self.manifest['chunks'])):
+            yield self.chunk(index, kind)
+    def array(self, kind='class'):
+        # All rows of one kind ('class', 'patch' or 'labels') in memory
+        return np.concatenate(list(self.iter_chunks(kind)))
+
+def open_feature_store(directory, fingerprint):
+    # The store in directory if it was extracted with the same fingerprint, else None
+    if not os.path.exists(os.path.join(directory, 'manifest.json')):
+        return None
+    store = FeatureStore(directory)
+    return store if store.manifest.get('fingerprint') == fingerprint and store.manifest.get('version') == FEATURE_STORE_VERSION else None
+
+def extraction_loader(train):
+    # Unshuffled loader of a dataset split without random augmentation, and the normalization its batches still need
+    import torchvision.transforms as transforms
+    _, _, test_augmentation, dataset_class = dataset_transforms()
+    if dataset_cache_dir != "":
+        os.makedirs(dataset_cache_dir, exist_ok=True)
+        cache_prefix = os.path.join(dataset_cache_dir, f"{dataset}_{'train' if train else 'test'}")
+        return make_loader(CachedImageDataset(build_dataset_cache(dataset_class('data', train=train, download=True), cache_prefix)), shuffle=False), test_augmentation
+    transform = transforms.Compose([transforms.Resize((image_size, image_size)), transforms.ToTensor(), transforms.Normalize((0.5,) * in_channels, (0.5,) * in_channels)])
+    return make_loader(dataset_class('data', train=train, download=True, transform=transform), shuffle=False), None
+
+def extract_features(model, batches, directory, metadata, pool_patches=False):
+    # batches yields (images, labels or None, paths or None) with normalized images
+    model_to_device(model).eval()
+    writer = FeatureStoreWriter(directory, model.embedding_dim, pool_patches)
+    start = time.perf_counter()
+    with torch.no_grad(), autocast():
+        for images, labels, paths in batches:
+            class_features, patch_features = model.extract_features(to_device(images), pool_patches)
+            writer.add(class_features, patch_features, labels, paths)
+    manifest = writer.close(metadata)
+    elapsed = time.perf_counter() - start
+    print(f"Extracted {manifest['num_samples']} embeddings in {elapsed:.1f}s ({manifest['num_samples'] / elapsed:.1f} images/s) to '{directory}' ({len(manifest['chunks'])} chunks)")
+    return FeatureStore(directory)
+
+def dataset_feature_store(model, train):
+    # Feature store of a dataset split, extracted only if missing or stale
+    name = f"{dataset}_{'train' if train else 'test'}_{image_size}px"
+    directory = os.path.join(feature_store_dir, name)
+    fingerprint = f"{checkpoint_fingerprint(torch_save_dir)}:{name}:{pool_patch_features}:{feature_dtype}:{token_reduction}:{token_reduction_method}"
+    store = open_feature_store(directory, fingerprint)
+    if store is not None:
+        return store
+    loader, normalize = extraction_loader(train)
+    batches = ((images if normalize is None else normalize(to_device(images)), labels, None) for images, labels in loader)
+    return extract_features(model, batches, directory, {'fingerprint': fingerprint, 'source': name, 'classes': CLASS_NAMES[dataset]}, pool_patch_features)
+
+def folder_feature_store(model, folder):
+    name = f"folder_{os.path.basename(os.path.normpath(folder))}_{image_size}px"
+    directory = os.path.join(feature_store_dir, name)
+    normalization = BatchAugmentation(model.image_size, (0.5,) * in_channels, (0.5,) * in_channels, train=False)
+    batches = ((normalization(to_device(images)), None, paths)
+               for paths, images in stream_image_batches(folder, model.image_size, in_channels, predict_batch_size, predict_num_threads, max_prefetch=2 * predict_batch_size))
+    return extract_features(model, batches, directory, {'fingerprint': None, 'source': os.path.abspath(folder)}, pool_patch_features)
+
+def train_linear_probe(train_store, test_store, kind='class', epochs=100, batch_size=4096, lr=1e-3, weight_decay=1e-4):
+    # Linear classifier on stored embeddings; returns its test accuracy and training time
+    start = time.perf_counter()
+    train_features, train_labels = torch.from_numpy(train_store.array(kind)).to(device).float(), torch.from_numpy(train_store.array('labels')).to(device)
+    test_features, test_labels = torch.from_numpy(test_store.array(kind)).to(device).float(), torch.from_numpy(test_store.array('labels')).to(device)
+    probe = nn.Linear(train_features.size(1), len(train_store.manifest['classes'])).to(device)
+    optimizer = optim.AdamW(probe.parameters(), lr=lr, weight_decay=weight_decay)
+    scheduler = CosineAnnealingLR(optimizer, T_max=epochs)
+    criterion = nn.CrossEntropyLoss()
+    for _ in range(epochs):
+        for batch in torch.randperm(len(train_features), device=device).split(batch_size):
+            optimizer.zero_grad()
+            criterion(probe(train_features[batch]), train_labels[batch]).backward()
+            optimizer.step()
+        scheduler.step()
+    with torch.no_grad():
+        accuracy = 100 * (probe(test_features).argmax(1) == test_labels).float().mean().item()
+    return {'accuracy': accuracy, 'train_seconds': time.perf_counter() - start, 'num_train': len(train_features), 'num_test': len(test_features)}
+
+class KNNIndex:
+    # Exact cosine-similarity nearest neighbours over the embeddings of a feature store, searched block by block
+    def __init__(self, features, labels=None, block_size=65536):
+        self.blocks = []
+        for start in range(0, len(features), block_size):
+            block = torch.from_numpy(np.asarray(features[start:start + block_size], dtype=np.float32)).to(device)
+            self.blocks.append(F.normalize(block, dim=1).to(torch.float16 if device.type == 'cuda' else torch.float32))
+        self.block_size = block_size
+        self.labels = None if labels is None else torch.as_tensor(np.asarray(labels)).to(device)
+    @classmethod
+    def from_store(cls, store, kind='class', block_size=65536):
+        return cls(store.array(kind), store.array('labels'), block_size)
+    def __len__(self):
+        return sum(len(block) for block in self.blocks)
+    def search(self, queries, k=10):
+        # queries: [num_queries, embedding_dim]. Returns the similarities and store indices of the k nearest rows of every query.
+        queries = F.normalize(torch.as_tensor(queries, dtype=torch.float32).to(device), dim=1).to(self.blocks[0].dtype)
+        best_scores = torch.full((len(queries), 0), float('-inf'), device=device)
+        best_indices = torch.zeros((len(queries), 0), dtype=torch.long, device=device)
+        for block_index, block in enumerate(self.blocks):
+            scores, indices = torch.matmul(queries, block.T).float().topk(min(k, len(block)), dim=1)
+            # Running top-k over the blocks seen so far
+            best_scores, order = torch.cat((best_scores, scores), dim=1).topk(min(k, best_scores.size(1) + scores.size(1)), dim=1)
+            best_indices = torch.cat((best_indices, indices + block_index * self.block_size), dim=1).gather(1, order)
+        return best_scores, best_indices
+    def classify(self, queries, k=20):
+        # Majority vote of the k nearest labels, weighted by similarity
+        scores, indices = self.search(queries, k)
+        neighbour_labels = self.labels[indices]
+        votes = torch.zeros(len(queries), int(self.labels.max()) + 1, device=device).scatter_add_(1, neighbour_labels, scores)
+        return votes.argmax(1)
+
+def knn_accuracy(index, test_store, k=20, query_batch_size=1024):
+    test_features, test_labels = test_store.array('class'), torch.from_numpy(test_store.array('labels')).to(device)
+    predictions = torch.cat([index.classify(test_features[start:start + query_batch_size], k) for start in range(0, len(test_features), query_batch_size)])
+    return 100 * (predictions == test_labels).float().mean().item()
+
+def benchmark_knn(store_sizes=(10_000, 50_000, 200_000), query_counts=(1, 64), embedding_dim=512, k=10, block_size=65536, num_iters=5):
+    # Query latency vs. store size on random embeddings, blocked index vs. one similarity matrix over the whole store
+    results = []
+    for store_size in store_sizes:
+        features = np.random.randn(store_size, embedding_dim).astype(np.float32)
+        index = KNNIndex(features, block_size=block_size)
+        full = F.normalize(torch.from_numpy(features).to(device), dim=1).to(index.blocks[0].dtype)
+        for num_queries in query_counts:
+            queries = torch.randn(num_queries, embedding_dim)
+            timings = {}
+            for name, search in (('blocked', lambda: index.search(queries, k)),
+                                 ('full_matrix', lambda: torch.matmul(F.normalize(queries.to(device), dim=1).to(full.dtype), full.T).float().topk(k, dim=1))):
+                search() # Warmup
+                synchronize()
+                start = time.perf_counter()
+                for _ in range(num_iters):
+                    search()
+                synchronize()
+                timings[name] = 1000 * (time.perf_counter() - start) / num_iters
+            results.append({'store_size': store_size, 'num_queries': num_queries, 'blocked_ms': timings['blocked'], 'full_matrix_ms': timings['full_matrix'],
+                            'queries_per_sec': 1000 * num_queries / timings['blocked']})
+    return results
+
+def print_knn_report(results):
+    print(f"k-NN query latency vs. store size ({device.type.upper()}, exact cosine similarity, top-10)")
+    print(f"{'Store size':>10} | {'Queries':>7} | {'Blocked ms':>10} | {'Full matrix ms':>14} | {'Queries/s':>9}")
+    for r in results:
+        print(f"{r['store_size']:>10} | {r['num_queries']:>7} | {r['blocked_ms']:>10.2f} | {r['full_matrix_ms']:>14.2f} | {r['queries_per_sec']:>9.1f}")
+
+def run_extract(splits=('train', 'test'), folder=None):
+    model = load_model()
+    if folder is not None:
+        folder_feature_store(model, folder)
+        return
+    for split in splits:
+        store = dataset_feature_store(model, split == 'train')
+        print(f"Feature store '{store.directory}': {len(store)} embeddings of dimension {store.manifest['embedding_dim']} ({store.manifest['dtype']})")
+
+def run_probe(epochs=100, k=20):
+    model = load_model()
+    train_store, test_store = dataset_feature_store(model, train=True), dataset_feature_store(model, train=False)
+    result = train_linear_probe(train_store, test_store, epochs=epochs)
+    print(f"Linear probe on {result['num_train']} cached embeddings: {result['accuracy']:.2f}% test accuracy, trained in {result['train_seconds']:.1f}s ({epochs} epochs)")
+    if train_store.manifest['pool_patches']:
+        pooled = train_linear_probe(train_store, test_store, kind='patch', epochs=epochs)
+        print(f"Linear probe on mean patch embeddings: {pooled['accuracy']:.2f}% test accuracy, trained in {pooled['train_seconds']:.1f}s")
+    start = time.perf_counter()
+    accuracy = knn_accuracy(KNNIndex.from_store(train_store), test_store, k)
+    print(f"{k}-NN classifier: {accuracy:.2f}% test accuracy ({len(test_store)} queries against {len(train_store)} embeddings in {time.perf_counter() - start:.1f}s)")
+
+def run_knn(folder, k=5, output_file=r"neighbours.jsonl"):
+    # Nearest training images of every image in folder
+    model = load_model()
+    store = dataset_feature_store(model, train=True)
+    index = KNNIndex.from_store(store)
+    queries = folder_feature_store(model, folder)
+    class_names, labels = store.manifest['classes'], store.array('labels')
+    start = time.perf_counter()
+    scores, indices = index.search(queries.array('class'), k)
+    elapsed = time.perf_counter() - start
+    with open(output_file, 'w') as f:
+        for path, image_scores, image_indices in zip(queries.paths, scores.tolist(), indices.tolist()):
+            neighbours = [{'index': i, 'class_name': class_names[labels[i]], 'similarity': score} for i, score in zip(image_indices, image_scores)]
+            f.write(json.dumps({'filename': os.path.basename(path), 'neighbours': neighbours}) + "\n")
+    print(f"Found the {k} nearest of {len(store)} training images for {len(queries)} images in {1000 * elapsed:.1f} ms. Neighbours saved as '{output_file}'")
+
+"""# Command Line
+`python ViT.py <command>` runs one of the commands below; without a command, `mode` at the top of the file is used (as in the notebook). Options override the globals of Step 2.
+- `train [--resume] [--epochs N]`: train from scratch (or resume from `checkpoint_dir`), then classify the testing directory if one is set.
+- `eval [--tradeoff] [--early-exit]`: accuracy of the saved model on the test split, optionally with the token reduction and early-exit speed/accuracy tradeoffs.
+- `predict [folder]`: classify a folder of images (the testing directory of the dataset by default).
+- `benchmark [--scaling] [--data]`: synthetic throughput, memory and cold-start benchmarks. `benchmark --suite [--baseline F]`: reproducible component and pipeline timings as JSON, compared with a baseline.
+- `export [--variants ...] [--max-batches N]`: quantized and compiled CPU inference variants of the saved model, compared with fp32.
+- `serve [--host] [--port]`: HTTP inference server.
+- `extract [--split train test] [--folder F]`, `probe` and `knn <folder>`: embedding feature stores, linear probing and nearest-image lookup.
+
+`predict` and `serve` never import matplotlib (unless plotting) or the torchvision datasets, and never build the training pipeline, so they start quickly.
+"""
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False, argument_default=argparse.SUPPRESS) # Options may come before or after the command
+    common.add_argument('--dataset', choices=list(CLASS_NAMES), help="Dataset the model is (or was) trained on")
+    common.add_argument('--device', dest='device_preference', choices=['auto', 'cuda', 'cpu'], help="Device to run on")
+    common.add_argument('--native-resolution', action='store_true', help="Use the dataset's native resolution with 4px patches")
+    common.add_argument('--checkpoint', dest='torch_save_dir', help="Weights of the best model (.safetensors or .pth)")
+    common.add_argument('--token-reduction', dest='token_reduction', type=int, nargs='+', help="Tokens merged or pruned after each encoder block (one value, or one per block)")
+    common.add_argument('--token-reduction-method', dest='token_reduction_method', choices=TOKEN_REDUCTION_METHODS)
+    common.add_argument('--exit-layers', dest='exit_layers', type=int, nargs='*', help="Early-exit heads after these numbers of encoder blocks")
+    common.add_argument('--exit-threshold', dest='exit_threshold', type=float, help="Confidence at which a sample leaves at an early-exit head")
+    common.add_argument('--exit-budget-ms', dest='exit_budget_ms', type=float, help="Latency budget per request for early exit (0 disables it)")
+    parser = argparse.ArgumentParser(description="Train, evaluate, run and benchmark a Vision Transformer on CIFAR-10 or MNIST.", parents=[common])
+    commands = parser.add_subparsers(dest='command')
+    train_parser = commands.add_parser('train', parents=[common], help="Train the model")
+    train_parser.add_argument('--resume', action='store_true', help="Continue from the latest checkpoint in the checkpoint directory")
+    train_parser.add_argument('--epochs', type=int, default=5)
+    train_parser.add_argument('--checkpoint-dir', dest='checkpoint_dir')
+    train_parser.add_argument('--finetune-from', dest='finetune_from', help="Weights to start from instead of a random initialization")
+    eval_parser = commands.add_parser('eval', parents=[common], help="Evaluate the saved model on the test split")
+    eval_parser.add_argument('--tradeoff', action='store_true', help="Also measure test accuracy vs. throughput for a range of token reductions")
+    eval_parser.add_argument('--early-exit', action='store_true', help="Also report accuracy, mean blocks run and throughput of the early-exit policy")
+    eval_parser.add_argument('--max-batches', type=int, help="Only measure the tradeoff curves on this many test batches")
+    predict_parser = commands.add_parser('predict', parents=[common], help="Classify a folder of images")
+    predict_parser.add_argument('folder', nargs='?', help="Folder of .png/.jpg images (default: the testing directory of the dataset)")
+    predict_parser.add_argument('--output', dest='predictions_file', help="Predictions file (.csv or .jsonl)")
+    predict_parser.add_argument('--batch-size', dest='predict_batch_size', type=int)
+    predict_parser.add_argument('--threads', dest='predict_num_threads', type=int)
+    predict_parser.add_argument('--plot', dest='plot_predictions', action=argparse.BooleanOptionalAction, help="Save a grid of the predictions")
+    benchmark_parser = commands.add_parser('benchmark', parents=[common], help="Benchmark on synthetic data")
+    benchmark_parser.add_argument('--scaling', dest='benchmark_scaling', action='store_true', default=None, help="Also measure multi-process data-parallel scaling")
+    benchmark_parser.add_argument('--data', dest='benchmark_data', action='store_true', default=None, help="Also measure the data pipeline on the real dataset")
+    benchmark_parser.add_argument('--suite', action='store_true', help="Run the benchmark suite instead and write its results as JSON")
+    benchmark_parser.add_argument('--quick', action='store_true', help="Fewer shapes and iterations in the benchmark suite")
+    benchmark_parser.add_argument('--output', dest='benchmark_results_file', help="JSON file for the benchmark suite results")
+    benchmark_parser.add_argument('--baseline', dest='benchmark_baseline_file', help="Earlier benchmark suite results to compare against")
+    benchmark_parser.add_argument('--threshold', dest='benchmark_regression_threshold', type=float, help="Slowdown (as a fraction) above which a case is a regression")
+    export_parser = commands.add_parser('export', parents=[common], help="Export quantized and compiled CPU inference variants and compare them")
+    export_parser.add_argument('--variants', nargs='+', choices=EXPORT_VARIANTS, default=list(EXPORT_VARIANTS))
+    export_parser.add_argument('--max-batches', type=int, help="Only evaluate accuracy on this many test batches")
+    export_parser.add_argument('--export-dir', dest='export_dir')
+    extract_parser = commands.add_parser('extract', parents=[common], help="Write the embeddings of dataset splits or an image folder to a feature store")
+    extract_parser.add_argument('--split', dest='splits', nargs='+', choices=['train', 'test'], default=['train', 'test'])
+    extract_parser.add_argument('--folder', help="Extract the embeddings of a folder of images instead")
+    extract_parser.add_argument('--pool-patches', dest='pool_patch_features', action='store_true', help="Also store the mean patch embedding")
+    extract_parser.add_argument('--feature-dir', dest='feature_store_dir')
+    probe_parser = commands.add_parser('probe', parents=[common], help="Train a linear probe (and a k-NN classifier) on the stored embeddings")
+    probe_parser.add_argument('--probe-epochs', type=int, default=100)
+    probe_parser.add_argument('--feature-dir', dest='feature_store_dir')
+    knn_parser = commands.add_parser('knn', parents=[common], help="Find the nearest training images of every image in a folder")
+    knn_parser.add_argument('folder')
+    knn_parser.add_argument('--k', type=int, default=5)
+    knn_parser.add_argument('--feature-dir', dest='feature_store_dir')
+    serve_parser = commands.add_parser('serve', parents=[common], help="Serve the saved model over HTTP")
+    serve_parser.add_argument('--host', dest='serve_host')
+    serve_parser.add_argument('--port', dest='serve_port', type=int)
+    return parser
+
+def main(argv=None):
+    if argv is None: # Inside a notebook the kernel's own arguments are ignored and `mode` decides
+        argv = [] if 'ipykernel' in sys.modules else sys.argv[1:]
+    args = vars(build_parser().parse_args(argv))
+    command, resume, num_epochs, folder = args.pop('command', None), args.pop('resume', False), args.pop('epochs', 5), args.pop('folder', None)
+    variants, max_batches, tradeoff = args.pop('variants', EXPORT_VARIANTS), args.pop('max_batches', None), args.pop('tradeoff', False)
+    early_exit = args.pop('early_exit', False)
+    splits, probe_epochs, k = args.pop('splits', ('train', 'test')), args.pop('probe_epochs', 100), args.pop('k', 5)
+    suite, quick = args.pop('suite', False), args.pop('quick', False)
+    if command is None:
+        if mode not in ('train', 'resume', 'eval', 'predict', 'load', 'serve', 'benchmark', 'export', 'extract', 'probe'):
+            print("Please enter a valid mode (either 'train', 'resume', 'eval', 'predict', 'serve', 'benchmark', 'export', 'extract' or 'probe')!")
+            quit()
+        command, resume = {'resume': ('train', True), 'load': ('predict', False)}.get(mode, (mode, False))
+    configure(**{name: value for name, value in args.items() if value is not None})
+    init_runtime()
+    testing_dir = CIFAR_testing_dir if dataset == 'CIFAR10' else MNIST_testing_dir
+    if command == 'train':
+        if resume:
+            print(f"Continuing training from the latest checkpoint in '{checkpoint_dir}'. The model will proceed to train on {dataset}.\n")
+        else:
+            print(f"Training from scratch, overwriting the previous model checkpoint. The model will proceed to train on {dataset}.\n")
+        run_train(resume, num_epochs)
+        if is_main_process and testing_dir != "":
+            run_predict(testing_dir)
+    elif command == 'eval':
+        run_eval(tradeoff, max_batches, early_exit)
+    elif command == 'predict':
+        run_predict(testing_dir if folder is None else folder)
+    elif command == 'benchmark' and suite:
+        try:
+            regressions = run_benchmark_suite(quick)
+        except ValueError as e:
+            print(e)
+            sys.exit(2)
+        if regressions:
+            print(f"Performance regressions beyond {100 * benchmark_regression_threshold:.0f}%: {', '.join(c['case'] for c in regressions)}")
+            sys.exit(1)
+    elif command == 'benchmark':
+        print("Measuring throughput on synthetic data.\n")
+        run_benchmark()
+    elif command == 'export':
+        run_export(variants, max_batches)
+    elif command == 'extract':
+        run_extract(splits, folder)
+    elif command == 'probe':
+        run_probe(probe_epochs)
+    elif command == 'knn':
+        run_knn(folder, k)
+    elif command == 'serve':
+        run_serve()
+    print("Done!")
 
-print("Done!")
+if __name__ == '__main__':
+    main()
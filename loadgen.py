@@ -0,0 +1,106 @@
+"""Load generator for the ViT inference server (ViT.py in 'serve' mode).
+
+Sends concurrent POST /predict requests over keep-alive connections and reports throughput and latency
+percentiles for each concurrency level, followed by the server's own /metrics (batch-size histogram).
+
+Example:
+    python loadgen.py --images CIFAR_testing --concurrency 1 4 16 64 --requests 500
+"""
+
+from urllib.parse import urlparse
+from PIL import Image
+import numpy as np
+import argparse
+import asyncio
+import time
+import json
+import os
+import io
+
+
+def load_payloads(folder):
+    # Raw image bytes to upload. Without a folder, a random 32x32 PNG is used.
+    if folder:
+        payloads = []
+        for filename in sorted(os.listdir(folder)):
+            if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
+                with open(os.path.join(folder, filename), 'rb') as f:
+                    payloads.append(f.read())
+        if payloads:
+            return payloads
+        print(f"No images found in '{folder}', using a random image instead.")
+    buffer = io.BytesIO()
+    Image.fromarray(np.random.randint(0, 256, (32, 32, 3), dtype=np.uint8)).save(buffer, format='PNG')
+    return [buffer.getvalue()]
+
+
+async def http_request(reader, writer, host, method, path, body=b''):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            content_length = int(value)
+    return status, await reader.readexactly(content_length)
+
+
+async def client(host, port, payloads, num_requests, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in range(num_requests):
+            start = time.perf_counter()
+            status, _ = await http_request(reader, writer, host, 'POST', '/predict', payloads[i % len(payloads)])
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_level(host, port, payloads, concurrency, total_requests):
+    latencies, errors = [], []
+    per_client = [total_requests // concurrency + (i < total_requests % concurrency) for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, payloads, n, latencies, errors) for n in per_client if n > 0))
+    elapsed = time.perf_counter() - start
+    latencies = 1000 * np.array(latencies) if latencies else np.zeros(1)
+    return {'concurrency': concurrency, 'requests_per_sec': (total_requests - len(errors)) / elapsed, 'errors': len(errors),
+            'p50_ms': float(np.percentile(latencies, 50)), 'p90_ms': float(np.percentile(latencies, 90)), 'p99_ms': float(np.percentile(latencies, 99))}
+
+
+async def main(args):
+    url = urlparse(args.url)
+    host, port = url.hostname, url.port or 80
+    payloads = load_payloads(args.images)
+    # Warm up the server (first batches are slower)
+    await run_level(host, port, payloads, 1, 5)
+    results = []
+    print(f"{'Concurrency':>11} | {'Req/s':>8} | {'p50 ms':>8} | {'p90 ms':>8} | {'p99 ms':>8} | {'Errors':>6}")
+    for concurrency in args.concurrency:
+        r = await run_level(host, port, payloads, concurrency, max(args.requests, concurrency))
+        results.append(r)
+        print(f"{r['concurrency']:>11} | {r['requests_per_sec']:>8.1f} | {r['p50_ms']:>8.1f} | {r['p90_ms']:>8.1f} | {r['p99_ms']:>8.1f} | {r['errors']:>6}")
+    reader, writer = await asyncio.open_connection(host, port)
+    _, metrics = await http_request(reader, writer, host, 'GET', '/metrics')
+    writer.close()
+    metrics = json.loads(metrics)
+    print(f"Server metrics: mean batch size {metrics['mean_batch_size']:.1f}, batch-size histogram {metrics['batch_size_histogram']}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'levels': results, 'server_metrics': metrics}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure throughput vs. latency of the ViT inference server under concurrency.")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="Server address")
+    parser.add_argument('--images', default='', help="Folder of .png/.jpg images to upload (default: a random 32x32 image)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help="Concurrent clients per level")
+    parser.add_argument('--requests', type=int, default=500, help="Requests sent per concurrency level")
+    parser.add_argument('--output', default='', help="Optional JSON file for the results")
+    asyncio.run(main(parser.parse_args()))